@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Compare precompiled serializers against flask-restful marshal.
+Checks that output is byte-for-byte identical and prints timings.
+Also checks that list endpoints' load plans serialize a page
+with constant number of queries, whatever the data looks like.
+Uses data from configured database, so run it against a copy with some games.
+Query counts are also checked on generated data by tests/test_load_plans.py.
+
+Usage: ./bench_serializers.py [count] [repeat]
+"""
+
+import sys
+import json
+import time
+
+import main
+
+
+def bench(name, func, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = json.dumps(func())
+    spent = (time.perf_counter() - start) / repeat
+    print('  {:<10} {:8.2f} ms'.format(name, spent * 1000))
+    return result, spent
+
+
+def compare(title, fields_dict, serializer, objects, repeat):
+    from flask.ext.restful import fields, marshal
+
+    print('{} ({} objects):'.format(title, len(objects)))
+    old, old_time = bench(
+        'marshal',
+        lambda: fields.List(fields.Nested(fields_dict)).format(objects),
+        repeat)
+    new, new_time = bench(
+        'compiled',
+        lambda: serializer.many(objects),
+        repeat)
+    if old != new:
+        print('  OUTPUT MISMATCH!')
+        return False
+    print('  identical output, {:.1f}x faster'.format(
+        old_time / new_time if new_time else 0))
+    return True
+
+
+def count_queries(func):
+    from sqlalchemy import event
+    from v1.main import db
+
+    counter = [0]
+
+    def before_execute(*args):
+        counter[0] += 1
+
+    db.session.expunge_all()  # so that nothing is taken from identity map
+    event.listen(db.engine, 'before_cursor_execute', before_execute)
+    try:
+        func()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_execute)
+    return counter[0]
+
+
+def page_queries(query, load_plan, serializer, count):
+    """
+    Number of queries needed to load and serialize a page of `count` items.
+    """
+    return count_queries(
+        lambda: serializer.many(query.options(*load_plan).limit(count).all()))
+
+
+def check_queries(title, query, load_plan, serializer, count, expected):
+    queries = page_queries(query, load_plan, serializer, count)
+    print('{}: {} queries (expected {}){}'.format(
+        title, queries, expected, '' if queries == expected else ' - FAILED'))
+    return queries == expected
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    main.init_app()
+    with main.app.test_request_context():
+        from v1.models import Player, Game, ChatMessage, Event
+        from v1.routes import (PlayerResource, GameResource,
+                               ChatMessageResource, EventResource)
+
+        queries_ok = all([
+            # main query + children subquery
+            check_queries('Games with children',
+                          Game.query.filter(Game.children.any()),
+                          GameResource.load_plan, GameResource.serializer,
+                          count, 2),
+            check_queries('Games without children',
+                          Game.query.filter(~Game.children.any()),
+                          GameResource.load_plan, GameResource.serializer,
+                          count, 2),
+            check_queries('Chat messages',
+                          ChatMessage.query,
+                          ChatMessageResource.load_plan,
+                          ChatMessageResource.serializer,
+                          count, 1),
+            check_queries('Events',
+                          Event.query,
+                          EventResource.load_plan, EventResource.serializer,
+                          count, 1),
+        ])
+
+        ok = queries_ok and all([
+            compare('Players (leaderboard)',
+                    PlayerResource.fields(public=True, stat=True),
+                    PlayerResource.serializer(public=True, stat=True),
+                    Player.query.limit(count).all(), repeat),
+            compare('Games',
+                    GameResource.fields,
+                    GameResource.serializer,
+                    Game.query.order_by(Game.id.desc()).limit(count).all(),
+                    repeat),
+            compare('Chat messages',
+                    ChatMessageResource.fields,
+                    ChatMessageResource.serializer,
+                    ChatMessage.query.order_by(
+                        ChatMessage.id.desc()).limit(count).all(),
+                    repeat),
+            compare('Events',
+                    EventResource.fields,
+                    EventResource.serializer,
+                    Event.query.order_by(Event.id.desc()).limit(count).all(),
+                    repeat),
+        ])
+    sys.exit(0 if ok else 1)
@@ -31,6 +31,12 @@ from secret import DATADOG_API_KEY
 
 JWT_LIFETIME = timedelta(days=365)
 
+# PBKDF2 iterations for new password hashes;
+# existing ones are rehashed on login when this is raised
+PASSWORD_ITERATIONS = 10000
+# how many passwords can be hashed at once (in native threads)
+PASSWORD_HASH_CONCURRENCY = 4
+
 # for Nexmo phone number verification
 SMS_BRAND = "Bet Game"
 SMS_SENDER = "BetGame"
@@ -64,4 +70,15 @@ WITHDRAW_COEFFICIENT = 0.90
 
 OBSERVER_URL = 'http://localhost:8021'
 
+# how many pollers (gametypes/gamemodes) can be polled simultaneously
+POLL_CONCURRENCY = 8
+
+# log API requests which ran more SQL queries than this
+# (to catch N+1 problems); None to disable
+QUERY_COUNT_THRESHOLD = 50
+
+# socket.io emits are brokered through it, so several server instances
+# (each with its own sockets) can run at once
+SOCKETIO_MESSAGE_QUEUE = 'redis://localhost:6379/0'
+
 SITE_BASE_URL = 'https://betgame.co.uk'
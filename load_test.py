@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Simple load test: hammers some REST endpoints and opens socket.io
+handshakes for given time, then prints throughput.
+Run it against one instance, then against several ones behind nginx
+(see serve.sh and README) to see how throughput scales.
+
+Usage: ./load_test.py base_url [concurrency] [seconds] [token]
+e.g.   ./load_test.py http://localhost 100 30
+"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import sys
+import time
+from collections import Counter
+
+import requests
+
+
+def worker(base, token, deadline, stats):
+    session = requests.Session()
+    if token:
+        session.headers['Authorization'] = 'Bearer ' + token
+    paths = [
+        '/v1/gametypes',
+        '/v1/players?results_per_page=20',
+        '/v1/socket.io/?EIO=3&transport=polling', # socket handshake
+    ]
+    if token:
+        paths.append('/v1/games?results_per_page=20')
+    n = 0
+    while time.time() < deadline:
+        path = paths[n % len(paths)]
+        n += 1
+        started = time.time()
+        try:
+            ret = session.get(base + path, timeout=30)
+        except requests.RequestException:
+            stats['errors'] += 1
+            continue
+        stats['latency'] += time.time() - started
+        stats['requests'] += 1
+        if ret.status_code >= 500:
+            stats['errors'] += 1
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    base = sys.argv[1].rstrip('/')
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    seconds = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    token = sys.argv[4] if len(sys.argv) > 4 else None
+
+    stats = Counter()
+    pool = eventlet.GreenPool(concurrency)
+    started = time.time()
+    deadline = started + seconds
+    for i in range(concurrency):
+        pool.spawn(worker, base, token, deadline, stats)
+    pool.waitall()
+    spent = time.time() - started
+
+    print('{} requests in {:.1f} s with concurrency {}'.format(
+        stats['requests'], spent, concurrency))
+    print('  throughput: {:.1f} req/s'.format(stats['requests'] / spent))
+    if stats['requests']:
+        print('  avg latency: {:.1f} ms'.format(
+            stats['latency'] / stats['requests'] * 1000))
+    print('  errors: {}'.format(stats['errors']))
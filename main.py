@@ -140,4 +140,65 @@ if __name__ == '__main__':
         """
         pass
 
+    @manager.command
+    def rebuild_stats():
+        """Recalculate player_stats and player_daily_stats tables from games.
+        Run after applying migration, or if stats seem inconsistent.
+        """
+        from v1.models import PlayerStats
+
+        count = PlayerStats.rebuild()
+        print('Rebuilt {} stats rows'.format(count))
+
+    @manager.command
+    def rebuild_leaderboard():
+        """Recreate redis rank index used for leaderposition.
+        Run after rebuild_stats or if redis data was lost.
+        """
+        from v1.models import PlayerStats
+
+        count = PlayerStats.rebuild_ranks()
+        print('Indexed {} players'.format(count))
+
+    @manager.command
+    def rebuild_search_index():
+        """Recreate player_search_token table used by player search.
+        Run after applying migration.
+        """
+        from v1.models import PlayerSearchToken
+
+        count = PlayerSearchToken.rebuild()
+        print('Indexed {} players'.format(count))
+
+    @manager.command
+    def backfill_uploads():
+        """Fill userpic_ext and message_ext columns from uploaded files.
+        Run only once, after applying migration.
+        """
+        from v1.models import Player, Game
+        from v1.routes import UserpicResource, GameMessageResource
+
+        for model, resource in ((Player, UserpicResource),
+                                (Game, GameMessageResource)):
+            count = 0
+            for entity in model.query.yield_per(1000):
+                f = resource.findfile(entity)
+                if f:
+                    setattr(entity, resource.COLUMN + '_ext',
+                            f.rsplit('.', 1)[-1])
+                    setattr(entity, resource.COLUMN + '_version', 1)
+                    count += 1
+            db.session.commit()
+            print('{}: {} files found'.format(model.__name__, count))
+
+    @manager.command
+    def rebuild_conversations():
+        """Recreate conversation inbox table from chat messages.
+        Run after applying migration.
+        """
+        from v1.models import Conversation
+
+        count = Conversation.rebuild()
+        print('Rebuilt {} conversation rows'.format(count))
+
     manager.run()
@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 
+import eventlet
+eventlet.monkey_patch() # pollers run concurrently in green threads
+
 import main, v1
 
 if __name__ == '__main__':
     # for db access to work
     main.live().app_context().push()
 
-    v1.polling.poll_all()
+    try:
+        v1.polling.poll_all()
+    finally:
+        # buffered metrics would be lost on exit otherwise
+        v1.helpers.dd_buffer.flush()
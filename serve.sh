@@ -2,7 +2,7 @@
 if [ "$1" == "-d" ]; then
 	# debug
 	bind=localhost:${2:-8080}
-	workers=1
+	instances=1
 	app='main:debug()'
 	opts="--reload --preload --timeout 3600"
 	shift; shift
@@ -17,11 +17,30 @@ else
 		port=8001
 	fi
 	bind=${1:-localhost:$port}
-	workers=${2:-1} # was 3, but socket.io requires 1
+	# socket.io needs sticky sessions, so instead of several workers
+	# we run several one-worker instances on consecutive ports
+	# and balance them in nginx with ip_hash (see README)
+	instances=${2:-1}
 	logfile="/home/betgame/betgame${testing}.log"
 	app="main:live('$logfile')"
 	opts="--name betgame${testing:--main} --access-logfile /home/betgame/access${testing}.log --error-logfile /home/betgame/errors${testing}.log"
 	shift 2
 fi
 # --preload 
-exec gunicorn "$@" $opts --workers ${workers} --worker-class eventlet --bind ${bind} -m 007 "$app"
+if [ "$instances" -eq 1 ]; then
+	exec gunicorn "$@" $opts --workers 1 --worker-class eventlet --bind ${bind} -m 007 "$app"
+fi
+host=${bind%:*}
+port=${bind##*:}
+trap 'kill $(jobs -p) 2>/dev/null' EXIT
+trap 'exit' TERM INT
+# supervisor signals this script rather than gunicorn,
+# so pass reload request on to every instance
+trap 'kill -HUP $(jobs -p)' HUP
+for i in $(seq 0 $((instances-1))); do
+	gunicorn "$@" $opts --name betgame${testing:--main}-$i --workers 1 --worker-class eventlet --bind ${host}:$((port+i)) -m 007 "$app" &
+done
+# wait is interrupted by trapped signals, so resume it while instances run
+while [ -n "$(jobs -pr)" ]; do
+	wait
+done
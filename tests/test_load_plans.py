@@ -0,0 +1,172 @@
+"""
+Checks that list endpoints' load plans serialize a page
+with constant number of queries, on generated data in SQLite.
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from bench_serializers import count_queries, page_queries
+
+
+PAGE = 50
+_dbfile = None
+
+
+def setUpModule():
+    global _dbfile
+    fd, _dbfile = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    main.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + _dbfile
+    main.app.config['TESTING'] = True
+    main.init_app()
+
+    from v1.main import db
+    with main.app.app_context():
+        db.create_all()
+        fill_db(db)
+
+
+def tearDownModule():
+    os.remove(_dbfile)
+
+
+def fill_db(db):
+    """
+    More than a page of every kind of item,
+    with all relationships which serializers follow.
+    """
+    from v1.models import Player, Game, ChatMessage, Event
+
+    players = []
+    for i in range(10):
+        p = Player()
+        p.nickname = 'player{}'.format(i)
+        p.email = 'player{}@example.com'.format(i)
+        db.session.add(p)
+        players.append(p)
+
+    now = datetime.utcnow()
+
+    def game(n, parent=None):
+        g = Game()
+        g.creator = players[n % len(players)]
+        g.opponent = players[(n + 1) % len(players)]
+        g.gametype = 'fifa15-xboxone'
+        g.gamemode = 'fifaSeasons'
+        g.bet = 1
+        g.create_date = now - timedelta(minutes=n)
+        if n % 3:
+            g.state = 'accepted'
+            g.accept_date = g.create_date
+        else:
+            g.state = 'aborted'
+            g.aborter = g.creator
+        if parent:
+            g.parent = parent
+        db.session.add(g)
+        return g
+
+    # odd roots have children, so both kinds fill a page
+    for n in range(PAGE * 2 + 10):
+        root = game(n)
+        if n % 2:
+            for k in range(2):
+                game(n * 2 + k, root)
+
+        msg = ChatMessage()
+        msg.sender = players[n % len(players)]
+        msg.receiver = players[(n + 1) % len(players)]
+        msg.game = root
+        msg.text = 'message {}'.format(n)
+        db.session.add(msg)
+
+        evt = Event()
+        evt.root = root
+        if n % 2:
+            evt.type = 'message'
+            evt.message = msg
+        else:
+            evt.type = 'betstate'
+            evt.game = root
+            evt.newstate = root.state
+        db.session.add(evt)
+    db.session.commit()
+
+
+class LoadPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.ctx = main.app.test_request_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def assertPageQueries(self, query, resource, expected):
+        self.assertEqual(
+            page_queries(query, resource.load_plan, resource.serializer,
+                         PAGE),
+            expected)
+
+    def test_games_with_children(self):
+        from v1.models import Game
+        from v1.routes import GameResource
+        # main query + children subquery
+        self.assertPageQueries(Game.query.filter(Game.children.any()),
+                               GameResource, 2)
+
+    def test_games_without_children(self):
+        from v1.models import Game
+        from v1.routes import GameResource
+        self.assertPageQueries(Game.query.filter(~Game.children.any()),
+                               GameResource, 2)
+
+    def test_games_paginated(self):
+        from v1.main import db
+        from v1.models import Game
+        from v1.routes import GameResource
+
+        children = {}
+        for game_id, parent_id in db.session.query(Game.id, Game.parent_id):
+            children.setdefault(game_id, set())
+            if parent_id:
+                children.setdefault(parent_id, set()).add(game_id)
+
+        # gametype is the same for all games, so that order has only ties
+        for order in None, 'gametype', '-create_date':
+            seen = []
+            for page in range(1, len(children) // PAGE + 2):
+                items = []
+                queries = count_queries(lambda: items.extend(
+                    GameResource.ordered(Game.query, order)
+                    .options(*GameResource.load_plan)
+                    .paginate(page, PAGE, error_out=False).items))
+                # count + main query + children subquery
+                self.assertLessEqual(queries, 3)
+                for game in items:
+                    self.assertEqual({c.id for c in game.children},
+                                     children[game.id])
+                seen.extend(game.id for game in items)
+            self.assertEqual(sorted(seen), sorted(children))
+
+    def test_chat_messages(self):
+        from v1.models import ChatMessage
+        from v1.routes import ChatMessageResource
+        self.assertPageQueries(ChatMessage.query, ChatMessageResource, 1)
+
+    def test_events(self):
+        from v1.models import Event
+        from v1.routes import EventResource
+        self.assertPageQueries(Event.query, EventResource, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
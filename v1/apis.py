@@ -1,7 +1,12 @@
 from flask import request
 
 import os
+import re
+import math
+import urllib.parse
+import json
 import time
+import threading
 from datetime import datetime, timedelta
 from collections import OrderedDict, namedtuple
 import email
@@ -10,10 +15,12 @@ from requests_oauthlib import OAuth1Session
 
 try:
     import config
-    from .helpers import log
+    from .helpers import log, dd_stat
+    from .main import redis
 except ImportError:
     # test environment
     from .mock import config, log
+    redis = dd_stat = None
 
 ### External APIs ###
 def nexmo(endpoint, **kwargs):
@@ -158,7 +165,58 @@ class Fixer:
 
         return rate
 
+class MailTemplate:
+    """
+    Mail template with `{key}` placeholders, parsed once.
+    Unknown placeholders are left as is,
+    so templates may contain other curly braces (e.g. in css).
+    """
+    path = os.path.dirname(__file__)+'/../templates/mail' # relative to self
+    placeholder = re.compile(r'\{(\w+)\}')
+    _all = {}
+
+    def __init__(self, text):
+        # even items are literal text, odd ones are keys
+        self.parts = self.placeholder.split(text)
+
+    def render(self, values):
+        return ''.join(
+            part if not n % 2
+            else str(values[part]) if part in values
+            else '{%s}' % part
+            for n, part in enumerate(self.parts)
+        )
+
+    @classmethod
+    def load_all(cls):
+        texts = {}
+        for fname in os.listdir(cls.path):
+            name, ext = os.path.splitext(fname)
+            with open('{}/{}'.format(cls.path, fname), 'r') as f:
+                texts[name, ext[1:]] = f.read()
+        for (name, ext), text in texts.items():
+            cls._all[name, ext, False] = cls(text)
+            if name != 'base':
+                # base has no placeholders but {content}
+                cls._all[name, ext, True] = cls(
+                    texts['base', ext].replace('{content}', text))
+
+    @classmethod
+    def get(cls, name, ext, usebase=True):
+        return cls._all[name, ext, usebase]
+MailTemplate.load_all()
+
+MAIL_QUEUE_KEY = '{}.mail_queue'.format('test' if config.TEST else 'prod')
+MAIL_RETRY_KEY = '{}.mail_retry'.format('test' if config.TEST else 'prod')
+MAIL_BATCH = 50 # max mails to take from queue at once
+MAIL_RETRIES = 8 # with backoff it is about 2 hours
+MAIL_RETRY_DELAY = 30 # seconds, doubled with each try
+
 def mailsend(user, mtype, sender=None, delayed=None, usebase=True, **kwargs):
+    """
+    Renders mail of given type and queues it for sending by `mail_worker`.
+    Returns True if queued.
+    """
     subjects = dict(
         greeting = 'Welcome to BetGame',
         greet_personal = 'Hey {}'.format(user.nickname or 'BetGame user'),
@@ -171,46 +229,102 @@ def mailsend(user, mtype, sender=None, delayed=None, usebase=True, **kwargs):
     kwargs['name'] = user.nickname
     kwargs['email'] = user.email
 
-    def load(name, ext, values, base=False):
-        f = open('{}/templates/mail/{}.{}'.format(
-            os.path.dirname(__file__)+'/..', # load from path relative to self
-            name, ext
-        ), 'r')
-        txt = f.read()
-        for key,val in values.items():
-            txt = txt.replace('{%s}' % key, str(val))
-        if not base:
-            txt = load('base', ext, dict(
-                content = txt,
-            ), base=True)
-        return txt
-
     params = {
         'from': sender or config.MAIL_SENDER,
         'to': '{} <{}>'.format(user.nickname, user.email),
         'subject': subjects[mtype],
-        'text': load(mtype, 'txt', kwargs, not usebase),
-        'html': load(mtype, 'html', kwargs, not usebase),
+        'text': MailTemplate.get(mtype, 'txt', usebase).render(kwargs),
+        'html': MailTemplate.get(mtype, 'html', usebase).render(kwargs),
     }
     if delayed:
         params['o:deliverytime'] = email.utils.format_datetime(
             datetime.utcnow() + delayed
         )
-    ret = requests.post(
-        'https://api.mailgun.net/v3/{}/messages'.format(config.MAIL_DOMAIN),
-        auth=('api',config.MAILGUN_KEY),
-        data=params,
-    )
+    redis.rpush(MAIL_QUEUE_KEY, json.dumps(dict(
+        params=params,
+        mtype=mtype,
+        user=str(user),
+        time=time.time(),
+        tries=0,
+    )))
+    return True
+
+def mail_worker():
+    """
+    Sends queued mails, never returns.
+    Is run by worker.py.
+    """
+    session = requests.Session() # keep connection to mailgun
+    while True:
+        try:
+            # move mails which are due for retry back to queue
+            now = time.time()
+            due = redis.zrangebyscore(MAIL_RETRY_KEY, 0, now)
+            if due:
+                pipe = redis.pipeline()
+                pipe.zremrangebyscore(MAIL_RETRY_KEY, 0, now)
+                pipe.rpush(MAIL_QUEUE_KEY, *due)
+                pipe.execute()
+
+            item = redis.blpop(MAIL_QUEUE_KEY, MAIL_RETRY_DELAY)
+            if not item:
+                continue
+            pipe = redis.pipeline()
+            pipe.lrange(MAIL_QUEUE_KEY, 0, MAIL_BATCH-2)
+            pipe.ltrim(MAIL_QUEUE_KEY, MAIL_BATCH-1, -1)
+            pipe.llen(MAIL_QUEUE_KEY)
+            rest, _, depth = pipe.execute()
+            dd_stat.gauge('mail.queue_depth', depth)
+
+            for raw in [item[1]] + rest:
+                mail = json.loads(raw.decode())
+                if mail_send_queued(session, mail) is None:
+                    mail['tries'] += 1
+                    if mail['tries'] > MAIL_RETRIES:
+                        log.error('Giving up sending {} mail to {}'.format(
+                            mail['mtype'], mail['user']))
+                        dd_stat.increment('mail.dropped')
+                        continue
+                    retry_at = time.time() + (
+                        MAIL_RETRY_DELAY * 2 ** (mail['tries'] - 1))
+                    redis.zadd(MAIL_RETRY_KEY, **{json.dumps(mail): retry_at})
+        except Exception:
+            log.exception('Mail worker failure')
+            time.sleep(1)
+
+def mail_send_queued(session, mail):
+    """
+    Posts one queued mail to Mailgun.
+    Returns True if sent, False if rejected,
+    or None for temporary failure which should be retried.
+    """
+    try:
+        ret = session.post(
+            'https://api.mailgun.net/v3/{}/messages'.format(config.MAIL_DOMAIN),
+            auth=('api',config.MAILGUN_KEY),
+            data=mail['params'],
+            timeout=30,
+        )
+    except requests.RequestException:
+        log.warning('Failed to send {} mail to {}, will retry'.format(
+            mail['mtype'], mail['user']), exc_info=True)
+        return None
+    if ret.status_code == 429 or ret.status_code >= 500:
+        log.warning('Mailgun returned {} for {} mail to {}, will retry'.format(
+            ret.status_code, mail['mtype'], mail['user']))
+        return None
     try:
         jret = ret.json()
         if 'id' in jret:
             log.info('mail sent: '+jret['message'])
+            dd_stat.histogram('mail.latency', time.time() - mail['time'])
             return True
         else:
             log.error('mail sending failed: '+jret['message'])
             return False
     except Exception:
-        log.exception('Failed to send {} mail to {}'.format(mtype, user))
+        log.exception('Failed to send {} mail to {}'.format(
+            mail['mtype'], mail['user']))
         log.error('{} {}'.format(ret.status_code, ret.text))
         return False
 
@@ -268,31 +382,153 @@ class JsonApi:
         return resp
 
 class LimitedApi(JsonApi):
-    # this is default delay between subsequent requests to the same api,
-    # can be overriden in subclasses
+    # Requests to each api are limited with token buckets stored in Redis,
+    # so that all processes (web workers, poller, observer) share them.
+    # LIMITS is a list of (burst, rate) buckets which all must give a token;
+    # bucket with capacity `burst` refilled at `rate` per second
+    # lets through at most burst + rate*T requests in any T seconds.
+    # By default it is one bucket with BURST and one request per DELAY.
+    # Can be overriden in subclasses.
     DELAY = timedelta(seconds=2)
+    BURST = 1
+    LIMITS = None
+    # how many times to retry request which got 429 Too Many Requests
+    RETRIES = 3
+    # how long to hold requests after 429 without Retry-After, in seconds
+    RETRY_AFTER = 10
+
+    BUCKET_KEY = '{}.ratelimit.{{}}'.format('test' if config.TEST else 'prod')
+    # Takes a token from each bucket, allowing tokens count to go negative:
+    # then caller should wait until its tokens are refilled.
+    # Returns that wait time in seconds (as string to keep fraction).
+    # KEYS: block-until key, bucket hashes;
+    # ARGV: now, then rate and burst for each bucket.
+    BUCKET_SCRIPT = """
+        local now = tonumber(ARGV[1])
+        local wait = 0
+        for i = 2, #KEYS do
+            local rate = tonumber(ARGV[i*2-2])
+            local burst = tonumber(ARGV[i*2-1])
+            local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+            local tokens = tonumber(state[1]) or burst
+            local ts = tonumber(state[2]) or now
+            tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - 1
+            redis.call('HMSET', KEYS[i], 'tokens', tokens, 'ts', now)
+            redis.call('EXPIRE', KEYS[i],
+                       math.ceil((burst - tokens) / rate) + 60)
+            if -tokens / rate > wait then
+                wait = -tokens / rate
+            end
+        end
+        local blocked = tonumber(redis.call('GET', KEYS[1]) or 0)
+        if blocked - now > wait then
+            wait = blocked - now
+        end
+        return tostring(wait)
+    """
+    _script = None
+    _locks = {} # class -> lock, for local fallback
+
+    @classmethod
+    def limits(cls):
+        return cls.LIMITS or [(cls.BURST, 1 / cls.DELAY.total_seconds())]
+
+    @classmethod
+    def bucket(cls, method, url, *args, **kwargs):
+        """
+        Name of rate limit bucket for given request.
+        Can be overriden for apis which limit e.g. per region.
+        """
+        return cls.__name__
+
+    @classmethod
+    def wait_turn(cls, bucket):
+        """
+        Sleeps until we are allowed to make next request to given bucket.
+        """
+        key = cls.BUCKET_KEY.format(bucket)
+        try:
+            if not LimitedApi._script:
+                LimitedApi._script = redis.register_script(cls.BUCKET_SCRIPT)
+            limits = cls.limits()
+            args = [time.time()]
+            for burst, rate in limits:
+                args.extend([rate, burst])
+            wait = float(LimitedApi._script(
+                keys=[key + '.blocked'] + [
+                    '{}.{}'.format(key, n) for n in range(len(limits))
+                ],
+                args=args,
+            ))
+        except Exception:
+            if redis:
+                log.warning('Rate limiter failure, using local delay',
+                            exc_info=True)
+            return cls.wait_turn_local()
+        dd_stat.histogram('api.wait_time', wait, tags=['api:'+bucket])
+        if wait > 0:
+            time.sleep(wait)
+
+    @classmethod
+    def wait_turn_local(cls):
+        """
+        Process-local fallback: just keep DELAY between requests.
+        """
+        with LimitedApi._locks.setdefault(cls, threading.Lock()):
+            now = datetime.utcnow()
+            last = getattr(cls, '_last', None)
+            if last:
+                diff = now - last
+                delay = cls.DELAY - diff
+                seconds = delay.total_seconds()
+                if seconds > 0:
+                    time.sleep(seconds)
+            # and before we actually call the method, save current time
+            # (so that api's internal delay will count as a part of our delay)
+            cls._last = datetime.utcnow()
+
+    @classmethod
+    def block(cls, bucket, ret):
+        """
+        Hold all requests to given bucket as the api asks in Retry-After.
+        """
+        retry_after = ret.headers.get('Retry-After')
+        try:
+            seconds = float(retry_after)
+        except (TypeError, ValueError):
+            try:
+                seconds = (email.utils.parsedate_to_datetime(retry_after)
+                           .timestamp() - time.time())
+            except (TypeError, ValueError):
+                seconds = cls.RETRY_AFTER
+        seconds = max(seconds, 1)
+        log.warning('{} API: too many requests, holding for {} s'.format(
+            bucket, seconds))
+        if redis:
+            try:
+                key = cls.BUCKET_KEY.format(bucket) + '.blocked'
+                redis.setex(key, math.ceil(seconds), time.time() + seconds)
+                dd_stat.increment('api.throttled', tags=['api:'+bucket])
+                return
+            except Exception:
+                log.warning('Rate limiter failure', exc_info=True)
+        time.sleep(seconds)
 
     @classmethod
     def request(cls, *args, **kwargs):
         """
-        This overrides JsonApi's method adding delay.
+        This overrides JsonApi's method adding rate limiting.
         """
-        # TODO: maybe use session for delaying?
-        now = datetime.utcnow()
-        last = getattr(cls, '_last', None)
-        if last:
-            diff = now - last
-            delay = cls.DELAY - diff
-            seconds = delay.total_seconds()
-            if seconds > 0:
-                time.sleep(seconds)
-        # and before we actually call the method, save current time
-        # (so that api's internal delay will count as a part of our delay)
-        cls._last = datetime.utcnow()
-
-        # now that we slept if needed, call Requests
-        # and handle any json-related problems
-        return super().request(*args, **kwargs)
+        bucket = cls.bucket(*args, **kwargs)
+        for tries in range(cls.RETRIES + 1):
+            cls.wait_turn(bucket)
+            # now that we waited if needed, call Requests
+            # and handle any json-related problems
+            ret = super().request(*args, **kwargs)
+            if ret.status_code != 429:
+                break
+            cls.block(bucket, ret)
+        return ret
 
 class Riot(LimitedApi):
     URL = 'https://{region}.api.pvp.net/api/lol/{region}/{version}/{method}'
@@ -301,6 +537,18 @@ class Riot(LimitedApi):
         'lan', 'las', 'na', 'oce',
         'ru', 'tr',
     ]
+    # development key allows 10 requests per 10 seconds
+    # and 500 requests per 10 minutes, separately for each region:
+    # short bucket gives 1 + 0.9*10 = 10 per 10 seconds,
+    # but 541 per 10 minutes, so long one caps it to 50 + 0.75*600 = 500
+    LIMITS = [(1, 0.9), (50, 0.75)]
+    DELAY = timedelta(seconds=1/0.75) # for local fallback
+
+    @classmethod
+    def bucket(cls, method, url, *args, **kwargs):
+        # region is the first part of hostname
+        return '{}.{}'.format(cls.__name__, urllib.parse.urlsplit(url)
+                              .hostname.split('.')[0])
 
     @classmethod
     def summoner_check(cls, val, region = None):
@@ -7,23 +7,120 @@ from flask.ext.restful.utils import http_status_message
 from werkzeug.exceptions import HTTPException
 
 import os
+import time
 import urllib.parse
 import jwt
-import hashlib, uuid
+import hashlib, hmac, uuid
+import struct
 from urllib.parse import quote
 import json
 import requests
 from functools import wraps
 import binascii
+import base64
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from dateutil.parser import parse as date_parse
 import apns_clerk
 import datadog as datadog_api
+import eventlet
 from eventlet.timeout import Timeout
+from eventlet.semaphore import Semaphore
+from eventlet import tpool
+from eventlet.queue import LightQueue, Full, Empty
 
 import config
 from .models import *
 from .main import db, redis
 from .common import *
 
+class DatadogBuffer:
+    """
+    Bounded in-process buffer for datadog events and statsd metrics.
+    Callers never wait for network: items are sent in batches
+    by a background greenlet, and are dropped (and counted)
+    when the buffer is full.
+    """
+    def __init__(self, maxsize=1000, batch=100):
+        self.queue = LightQueue(maxsize)
+        self.batch = batch
+        self.dropped = 0
+        self.flusher = None
+        self.sending = False
+
+    def put(self, kind, *args, **kwargs):
+        try:
+            self.queue.put_nowait((kind, args, kwargs))
+        except Full:
+            self.dropped += 1
+        if not self.flusher:
+            self.flusher = eventlet.spawn(
+                self.flush_loop, current_app._get_current_object())
+
+    def take(self, items):
+        while len(items) < self.batch:
+            try:
+                items.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return items
+
+    def flush_loop(self, app):
+        with app.app_context():
+            while True:
+                items = [self.queue.get()]
+                self.sending = True
+                try:
+                    self.send(self.take(items))
+                except Exception:
+                    log.exception('Datadog failure')
+                finally:
+                    self.sending = False
+
+    def flush(self):
+        """
+        Send everything buffered, synchronously.
+        Short-lived processes (like poll.py) should call it before exit,
+        as background greenlet won't get a chance to.
+        """
+        while self.sending:
+            eventlet.sleep(0.01) # let it finish current batch
+        if self.flusher:
+            self.flusher.kill() # it is idle now, waiting for next item
+            self.flusher = None
+        while True:
+            items = self.take([])
+            if not items and not self.dropped:
+                return
+            try:
+                self.send(items)
+            except Exception:
+                log.exception('Datadog failure')
+                return
+
+    def send(self, items):
+        statsd = datadog_api.statsd
+        statsd.open_buffer(self.batch + 1)
+        try:
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                log.warning('Datadog buffer overflow, {} items dropped'.format(
+                    dropped))
+                statsd.increment('datadog.dropped', dropped)
+            for kind, args, kwargs in items:
+                if kind == 'event':
+                    try:
+                        datadog_api.api.Event.create(*args, **kwargs)
+                    except Exception:
+                        log.exception('Datadog failure')
+                else:
+                    getattr(statsd, kind)(*args, **kwargs)
+        finally:
+            statsd.close_buffer()
+dd_buffer = DatadogBuffer()
+
 def datadog(title, text=None, _log=True, **tags):
     """
     Call log.info and send event to datadog
@@ -39,14 +136,25 @@ def datadog(title, text=None, _log=True, **tags):
                 tags.setdefault('user.id', g.user.id)
                 tags.setdefault('user.nickname', g.user.nickname)
                 tags.setdefault('user.email', g.user.email)
-            datadog_api.api.Event.create(
+            dd_buffer.put(
+                'event',
                 title=title,
                 text=text,
                 tags=[':'.join(map(str, item)) for item in tags.items()],
             )
         except:
             log.exception('Datadog failure')
-dd_stat = datadog_api.statsd
+
+class BufferedStatsd:
+    """
+    Drop-in replacement for `datadog.statsd` which sends via dd_buffer.
+    """
+    methods = {'increment', 'decrement', 'gauge', 'histogram', 'timing', 'set'}
+    def __getattr__(self, name):
+        if name not in self.methods:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: dd_buffer.put(name, *args, **kwargs)
+dd_stat = BufferedStatsd()
 
 
 ### Data returning ###
@@ -203,10 +311,89 @@ def makeToken(user, service=None, refresh_token=None,
     return token
 class BadUserId(Exception): pass
 class TokenExpired(Exception): pass
-def parseToken(token, userid=None, allow_longterm=False):
+
+# Verified tokens cache.
+# Process-local, like IPInfo cache, so that a hit costs no round trips.
+# Maps (token digest, allow_longterm) to verified payload
+# for TOKEN_CACHE_TTL (or less if token expires earlier).
+# On hit, signature and password salt are not checked again,
+# and Player row is only loaded when used.
+# Invalidations (logout, password change) are published to Redis
+# and applied by every API process; if that channel was down,
+# stale entries still live no longer than TOKEN_CACHE_TTL.
+TOKEN_CACHE_TTL = 60 # seconds
+TOKEN_CACHE_MAX = 10000
+TOKEN_FORGET_CHANNEL = '{}.tokens.forget'.format(
+    'test' if config.TEST else 'prod')
+_token_cache = OrderedDict()
+_token_listener = None
+def token_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+def _dropTokens(digest=None, sub=None):
+    if digest:
+        for longterm in (False, True):
+            _token_cache.pop((digest, longterm), None)
+    if sub:
+        for key, entry in list(_token_cache.items()):
+            if entry[1]['sub'] == sub:
+                _token_cache.pop(key, None)
+def _publishForget(**kwargs):
+    _dropTokens(**kwargs) # don't wait for the round trip here
+    try:
+        redis.publish(TOKEN_FORGET_CHANNEL, json.dumps(kwargs))
+    except Exception:
+        log.exception('Failed to publish token invalidation')
+def forgetToken(token):
     """
-    Returns a Player object if the token is valid,
-    raises an exception otherwise.
+    Drop given token from verified tokens cache of all processes.
+    """
+    _publishForget(digest=token_digest(token))
+def forgetTokens(user):
+    """
+    Drop all cached tokens of given user in all processes,
+    e.g. when password changed.
+    """
+    _publishForget(sub=user.id)
+def _listenTokens(flask_app):
+    with flask_app.app_context():
+        while True:
+            try:
+                p = redis.pubsub(ignore_subscribe_messages=True)
+                p.subscribe(TOKEN_FORGET_CHANNEL)
+                # invalidations could be missed while not subscribed
+                _token_cache.clear()
+                for msg in p.listen(): # blocks until next message
+                    data = msg.get('data')
+                    if isinstance(data, bytes):
+                        data = data.decode()
+                    try:
+                        _dropTokens(**json.loads(data))
+                    except (ValueError, TypeError):
+                        log.warning('Bad token invalidation: '+str(data))
+            except Exception:
+                log.exception('Token listener failure, will resubscribe')
+                eventlet.sleep(1)
+
+def lazyPlayer(player_id):
+    """
+    Returns Player with given id attached to current session
+    without querying DB: its columns are loaded on first access
+    to anything but id.
+    """
+    mapper = inspect(Player)
+    user = db.session.identity_map.get(
+        mapper.identity_key_from_primary_key([player_id]))
+    if user is None:
+        user = mapper.class_manager.new_instance() # bypass __init__
+        user.id = player_id
+        make_transient_to_detached(user) # marks other columns as expired
+        db.session.add(user)
+    return user
+
+def verifyToken(token, allow_longterm=False):
+    """
+    Verifies token signature and claims, and loads the player.
+    Returns tuple (payload, player).
     """
     try:
         header, payload = jwt.verify_jwt(token, config.JWT_SECRET, ['HS256'],
@@ -224,8 +411,6 @@ def parseToken(token, userid=None, allow_longterm=False):
         raise ValueError('Longterm token not allowed, use short-living one')
     if not payload['sub']:
         raise ValueError('Invalid userid in token: '+str(payload['sub']))
-    if userid and payload['sub'] != userid:
-        raise BadUserId
     user = Player.query.get(payload['sub'])
     if not user:
         raise ValueError("No such player")
@@ -235,10 +420,41 @@ def parseToken(token, userid=None, allow_longterm=False):
     if 'svc' in payload and cls == Client and 'longterm' in payload:
         if 'longterm' in payload:
             validateFederatedToken(payload.get('svc'), payload.get('refresh'))
+    return payload, user
+
+def parseToken(token, userid=None, allow_longterm=False):
+    """
+    Returns a Player object if the token is valid,
+    raises an exception otherwise.
+    """
+    global _token_listener
+    if not _token_listener:
+        _token_listener = eventlet.spawn(
+            _listenTokens, current_app._get_current_object())
+
+    key = (token_digest(token), bool(allow_longterm))
+    now = time.time()
+    entry = _token_cache.get(key)
+    if entry and entry[0] > now:
+        expires, payload = entry
+        user = lazyPlayer(payload['sub'])
+    else:
+        payload, user = verifyToken(token, allow_longterm)
+        expires = now + TOKEN_CACHE_TTL
+        if 'exp' in payload:
+            # re-check on hit is not needed then
+            expires = min(expires, payload['exp'])
+        _token_cache[key] = (expires, payload)
+        while len(_token_cache) > TOKEN_CACHE_MAX:
+            _token_cache.popitem(last=False)
+
+    if userid and payload['sub'] != userid:
+        raise BadUserId
 
     g.device_id = payload.get('device', None)
     # note that this dev id might be obsolete
     # if login was performed without token and then token was specified
+    g.token = token
 
     return user
 
@@ -280,6 +496,7 @@ def check_auth(userid=None,
     except TokenExpired:
         abort('Token expired, please obtain new one', 403, expired=True)
 
+    # not cached with token, as profile can be filled at any time
     if not allow_nonfilled and not user.complete:
         abort('Profile is incomplete, please fill!', 403)
 
@@ -407,6 +624,32 @@ def gamertag_force_field(val):
         g.gamertag_force = True
     return val
 
+# Password hashing.
+# PBKDF2 takes noticeable CPU time, so it runs in native threads
+# (hashlib releases GIL) instead of blocking the eventlet hub,
+# with at most PASSWORD_HASH_CONCURRENCY hashes at once.
+# Hash format is PASSWORD_HASH_PREFIX + iterations (4 bytes) + hash + salt;
+# legacy hashes are just hash + salt with 10000 iterations.
+# Salt is always the last 16 bytes, as tokens use its tail as fingerprint.
+PASSWORD_HASH_PREFIX = b'P2'
+PASSWORD_LEGACY_ITERATIONS = 10000
+_password_semaphore = Semaphore(config.PASSWORD_HASH_CONCURRENCY)
+def _pbkdf2(password, salt, iterations):
+    started = time.time()
+    with _password_semaphore:
+        dd_stat.histogram('password.queue_time', time.time() - started)
+        return tpool.execute(hashlib.pbkdf2_hmac,
+                             'SHA1', password.encode(), salt, iterations)
+def _hash_password(password, salt, iterations):
+    return b''.join([
+        PASSWORD_HASH_PREFIX, struct.pack('>I', iterations),
+        _pbkdf2(password, salt, iterations), salt,
+    ])
+def _password_iterations(reference):
+    if reference.startswith(PASSWORD_HASH_PREFIX) and len(reference) > 36:
+        return struct.unpack('>I', reference[2:6])[0]
+    return PASSWORD_LEGACY_ITERATIONS
+
 def encrypt_password(val):
     """
     Check password for weakness, and convert it to its hash.
@@ -425,13 +668,29 @@ def encrypt_password(val):
         raise ValueError("Too long password")
 
     salt = uuid.uuid4().bytes # 16 bytes
-    crypted = hashlib.pbkdf2_hmac('SHA1', val.encode(), salt, 10000)
-    return crypted+salt
+    return _hash_password(val, salt, config.PASSWORD_ITERATIONS)
 
 def check_password(password, reference):
     salt = reference[-16:] # last 16 bytes = uuid length
-    crypted = hashlib.pbkdf2_hmac('SHA1', password.encode(), salt, 10000)
-    return crypted+salt == reference
+    iterations = _password_iterations(reference)
+    if iterations == PASSWORD_LEGACY_ITERATIONS and len(reference) == 36:
+        crypted = _pbkdf2(password, salt, iterations)
+        return hmac.compare_digest(crypted+salt, reference)
+    return hmac.compare_digest(
+        _hash_password(password, salt, iterations), reference)
+
+def password_needs_rehash(reference):
+    """
+    Returns True if given password hash is weaker than configured one.
+    """
+    return _password_iterations(reference) < config.PASSWORD_ITERATIONS
+
+def rehash_password(password, reference):
+    """
+    Hash already checked password with current iterations count.
+    Salt is kept, so that issued tokens remain valid.
+    """
+    return _hash_password(password, reference[-16:], config.PASSWORD_ITERATIONS)
 
 def string_field(field, ftype=None, check_unique=True, allow_empty=False):
     """
@@ -571,15 +830,83 @@ class JsonField(restful.fields.Raw):
             return val
 
 
+# Pagination
+def keyset_paginate(query, model, order, after, limit):
+    """
+    Cursor-based (keyset) pagination, an alternative to `query.paginate`
+    which doesn't need OFFSET scan.
+    `order` is column name, optionally prefixed with `-` for descending;
+    model's id is always used as the second key.
+    `after` is an opaque cursor returned with previous page,
+    or empty string for the first page.
+    Returns (items, cursor for the next page or None if it was the last).
+    """
+    desc = order.startswith('-')
+    name = order.lstrip('-')
+    col = getattr(model, name)
+    pk = model.id
+
+    if after:
+        try:
+            c_order, value, last_id = json.loads(
+                base64.urlsafe_b64decode(after.encode()).decode())
+            if value is not None and isinstance(col.type, db.DateTime):
+                value = date_parse(value)
+        except (ValueError, TypeError):
+            abort('[after]: malformed cursor', problem='after')
+        if c_order != order:
+            abort('[after]: cursor was issued for another order',
+                  problem='after')
+        after_id = (pk < last_id) if desc else (pk > last_id)
+        if name == 'id':
+            cond = after_id
+        elif value is None:
+            # NULLs go first in ascending order
+            cond = (col == None) & after_id
+            if not desc:
+                cond = cond | (col != None)
+        else:
+            cond = ((col < value) if desc else (col > value)) | (
+                (col == value) & after_id)
+            if desc:
+                cond = cond | (col == None)
+        query = query.filter(cond)
+
+    orders = [pk] if name == 'id' else [col, pk]
+    query = query.order_by(*[o.desc() if desc else o.asc() for o in orders])
+    items = query.limit(limit + 1).all()
+
+    cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        cursor = make_cursor(order, items[-1])
+    return items, cursor
+
+
+def make_cursor(order, obj):
+    """
+    Returns cursor for `keyset_paginate` pointing right after given object.
+    """
+    value = getattr(obj, order.lstrip('-'))
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps(
+        [order, value, obj.id]
+    ).encode()).decode()
+
+
 # Notification
-apns_session = None
+PUSH_QUEUE_KEY = '{}.push_queue'.format('test' if config.TEST else 'prod')
+PUSH_BATCH = 100 # max queued pushes to send at once
+PUSH_TIMEOUT = 10 # seconds for one APNS send
+PUSH_RETRIES = 10
 def send_push(players, alert, **kwargs):
     """
     Sends PUSH message with given alert to given player(s).
     Kwargs holds message payload.
     This method will also send an event via Redis.
-    Returns True if sent successfully, False if sending failed
-    or None if no receivers were found (no push tokens).
+    PUSH itself is only queued here and will be sent by `push_worker`.
+    Returns True if queued, or None if no receivers were given.
     """
     if not isinstance(players, list):
         players = [players]
@@ -594,94 +921,156 @@ def send_push(players, alert, **kwargs):
             redis_msg,
         )
 
-    # now let's see if we need to send anything with push
-    receivers = []
-    #receivers.append('0'*64) # mock
-    for p in players:
-        for d in p.devices.filter_by(failed=False):
-            if d.push_token:
-                if len(d.push_token) == 64:
-                    # 64 hex digits = 32 bytes, valid token length
-                    receivers.append(d.push_token)
-                else:
-                    log.warning('Incorrect push token '+d.push_token)
-    if not receivers:
-        log.info('Not sending push to {} because no tokens available'.format(
-            ', '.join([
-                player.nickname for player in players
-            ]) or '(nobody)',
-        ))
+    if not players:
         return None
-    log.debug('Have {} receivers'.format(len(receivers)))
-
-    msg = apns_clerk.Message(
-        receivers,
+    redis.rpush(PUSH_QUEUE_KEY, json.dumps(dict(
+        players=[p.id for p in players],
         alert=alert,
-        badge='increment',
-        content_available=1,
-        **kwargs
-    )
+        payload=kwargs,
+        time=time.time(),
+    )))
+    return True
 
+def push_worker():
+    """
+    Sends queued pushes, never returns.
+    Is run by worker.py.
+    """
+    while True:
+        try:
+            item = redis.blpop(PUSH_QUEUE_KEY, 60)
+            if not item:
+                # nothing to send, let idle connections go
+                if apns_session:
+                    apns_session.outdate(timedelta(minutes=5))
+                continue
+            # take whatever else is queued, atomically
+            pipe = redis.pipeline()
+            pipe.lrange(PUSH_QUEUE_KEY, 0, PUSH_BATCH-2)
+            pipe.ltrim(PUSH_QUEUE_KEY, PUSH_BATCH-1, -1)
+            pipe.llen(PUSH_QUEUE_KEY)
+            rest, _, depth = pipe.execute()
+            dd_stat.gauge('push.queue_depth', depth)
+
+            send_pushes([
+                json.loads(i.decode()) for i in [item[1]] + rest
+            ])
+        except Exception:
+            log.exception('Push worker failure')
+            db.session.rollback()
+            eventlet.sleep(1)
+        finally:
+            # don't keep stale objects between batches
+            db.session.remove()
+
+def send_pushes(items):
+    """
+    Sends a batch of queued pushes, in order, over the same APNS connection.
+    Devices of all receivers are resolved with one query.
+    """
+    now = time.time()
+    for item in items:
+        dd_stat.histogram('push.queue_time', now - item['time'])
+
+    player_ids = {pid for item in items for pid in item['players']}
+    tokens = {}
+    for dev in Device.query.filter(
+        Device.player_id.in_(player_ids),
+        Device.failed == False,
+        Device.push_token != None,
+    ):
+        if len(dev.push_token) == 64:
+            # 64 hex digits = 32 bytes, valid token length
+            tokens.setdefault(dev.player_id, []).append(dev.push_token)
+        else:
+            log.warning('Incorrect push token '+dev.push_token)
+
+    failed = set()
+    for item in items:
+        item_tokens = [
+            token
+            for pid in item['players']
+            for token in tokens.get(pid, [])
+            if token not in failed # already known to be dead
+        ]
+        if not item_tokens:
+            log.info('Not sending push "{}" because no tokens available'
+                     .format(item['alert']))
+            continue
+        msg = apns_clerk.Message(
+            item_tokens,
+            alert=item['alert'],
+            badge='increment',
+            content_available=1,
+            **item['payload']
+        )
+        started = time.time()
+        ok, item_failed = send_apns(msg)
+        dd_stat.histogram('push.send_time', time.time() - started)
+        dd_stat.histogram('push.latency', time.time() - item['time'])
+        dd_stat.increment('push.sent' if ok else 'push.send_failed',
+                          len(item_tokens))
+        failed |= item_failed
+
+    if failed:
+        log.warning('Marking {} devices as failed'.format(len(failed)))
+        Device.query.filter(Device.push_token.in_(failed)).update(
+            {'failed': True}, synchronize_session=False)
+        db.session.commit()
+
+apns_session = None
+def send_apns(msg):
+    """
+    Sends given APNS message using persistent connection,
+    retrying if needed.
+    Returns tuple (success, set of failed tokens).
+    """
     global apns_session
     try:
         if not apns_session:
             apns_session = apns_clerk.Session()
     except Exception: # import error, OpenSSL error
         log.exception('APNS failure!')
-        return False
+        return False, set()
 
     # calculate path relative to this script location,
-    # because working directory may vary (for observer)
+    # because working directory may vary
     cert_file = os.path.dirname(__file__)+'/../apns_{}.pem'.format(config.APNS_CERT)
+    # session keeps this connection open between calls
     conn = apns_session.get_connection(
         'push_{}'.format(config.APNS_CERT),
         cert_file=cert_file)
 
     class PushTimeout(Exception):
         pass
-    def send_push_do(msg, tries=0):
-        log.debug('send_push: try {}'.format(tries))
-        log.debug('{} receivers remaining: {}'.format(
-            len(msg._tokens),
-            ', '.join(r[:2]+'-'+r[-2:] for r in msg._tokens),
-        ))
+    failed = set()
+    for tries in range(PUSH_RETRIES + 1):
+        log.debug('send_apns: try {}, {} receivers'.format(
+            tries, len(msg._tokens)))
         srv = apns_clerk.APNs(conn)
         try:
-            log.debug('sending..')
-            with Timeout(10, PushTimeout):
+            with Timeout(PUSH_TIMEOUT, PushTimeout):
                 ret = srv.send(msg)
-            log.info('push sending done for {}, {}'.format(msg, msg.alert))
         except PushTimeout:
             log.error('Push sending timeout', exc_info=True)
-            return False
+            return False, failed
         except Exception:
             log.error('APNS connection failure', exc_info=True)
-            return False
-        else:
-            for token, reason in ret.failed.items():
-                log.warning('Device {} failed by {}, shall remove'.format(token,reason))
-                dev = Device.query.filter_by(push_token=token).first()
-                if dev:
-                    log.warning('Marking as failed')
-                    dev.failed = True
-                    db.session.commit()
-                else:
-                    log.warning('No device found with this token!')
-
-            for code, error in ret.errors:
-                log.warning('Error {}: {}'.format(code, error))
+            return False, failed
 
-            if ret.needs_retry():
-                if tries < 10:
-                    log.info('needs retry.. so will retry')
-                    return send_push_do(ret.retry(), tries+1)
-                else:
-                    log.warning('needs retry.. but max retries exceed')
-                    return False
-            log.info('Push sending finished successfully')
-            return True
+        for token, reason in ret.failed.items():
+            log.warning('Device {} failed by {}, shall remove'.format(token,reason))
+            failed.add(token)
+        for code, error in ret.errors:
+            log.warning('Error {}: {}'.format(code, error))
 
-    return send_push_do(msg)
+        if not ret.needs_retry():
+            log.info('push sending done for {}, {}'.format(msg, msg.alert))
+            return True, failed
+        log.info('needs retry.. so will retry')
+        msg = ret.retry()
+    log.warning('needs retry.. but max retries exceed')
+    return False, failed
 
 
 def notify_event(root, etype, debug=False, **kwargs):
@@ -735,9 +1124,7 @@ def notify_event(root, etype, debug=False, **kwargs):
         return send_push(
             players,
             alert,
-            event=restful.marshal(
-                evt, routes.EventResource.fields
-            ),
+            event=routes.EventResource.serializer(evt),
         )
 
     if etype == 'message':
@@ -856,9 +1243,7 @@ def notify_chat(msg):
             msg.sender.nickname,
             msg.text,
         ),
-        message=restful.marshal(
-            msg, routes.ChatMessageResource.fields
-        ),
+        message=routes.ChatMessageResource.serializer(msg),
     )
 
 def notify_users(game, justpush=False, players=None, msg=None):
@@ -935,9 +1320,7 @@ def notify_users(game, justpush=False, players=None, msg=None):
     from . import routes # for fields list
     result = send_push(
         players, msg,
-        game=restful.marshal(
-            game, routes.GameResource.fields
-        )
+        game=routes.GameResource.serializer(game)
     )
     if result is None:
         result = True # had no tokens - it's okay
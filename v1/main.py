@@ -25,11 +25,12 @@ def init_app(flask_app):
     db.init_app(flask_app)
     api.init_app(flask_app)
     init_admin(flask_app)
+    init_metrics(flask_app)
     # FIXME! Socketio requires resource name to match on client and on server
     # so Nginx rewriting breaks it
     socketio.init_app(flask_app, resource='{}/v1/socket.io'.format(
         '/test' if config.TEST else ''
-    ))
+    ), message_queue=config.SOCKETIO_MESSAGE_QUEUE)
     redis.init_app(flask_app)
     flask_app.register_blueprint(app, url_prefix='/v1')
     flask_app.before_first_request_funcs.extend(_before1req)
@@ -85,3 +86,4 @@ db.MutaleDictPickleType = MutaleDictPickleType
 from . import routes
 from . import cas
 from .admin import init as init_admin
+from .metrics import init_app as init_metrics
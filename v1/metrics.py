@@ -0,0 +1,153 @@
+"""
+Per-endpoint request metrics.
+
+For each API request we count SQL statements and time spent in them
+(via engine events), outgoing HTTP calls and their time (by wrapping
+`requests.Session.send`), and total request latency.
+Results are sent to statsd tagged with endpoint name,
+and also aggregated in-process for `/debug/stats`.
+"""
+import time
+from collections import OrderedDict
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import requests
+
+import config
+
+from .common import log
+
+
+_stats = {} # endpoint -> EndpointStats
+
+
+class EndpointStats:
+    fields = ('requests', 'time', 'time_max',
+              'queries', 'queries_max', 'db_time',
+              'http_calls', 'http_time')
+
+    def __init__(self):
+        for f in self.fields:
+            setattr(self, f, 0)
+
+    def add(self, spent, counters):
+        self.requests += 1
+        self.time += spent
+        self.time_max = max(self.time_max, spent)
+        self.queries += counters['queries']
+        self.queries_max = max(self.queries_max, counters['queries'])
+        self.db_time += counters['db_time']
+        self.http_calls += counters['http_calls']
+        self.http_time += counters['http_time']
+
+    def summary(self):
+        n = self.requests or 1
+        return OrderedDict([
+            ('requests', self.requests),
+            ('avg_ms', round(self.time / n * 1000, 1)),
+            ('max_ms', round(self.time_max * 1000, 1)),
+            ('avg_queries', round(self.queries / n, 1)),
+            ('max_queries', self.queries_max),
+            ('avg_db_ms', round(self.db_time / n * 1000, 1)),
+            ('avg_http_calls', round(self.http_calls / n, 1)),
+            ('avg_http_ms', round(self.http_time / n * 1000, 1)),
+        ])
+
+
+def _counters():
+    """
+    Counters of current request, or None outside of API request.
+    """
+    if not has_request_context():
+        return None
+    return getattr(g, 'metrics', None)
+
+
+def before_request():
+    if not request.path.startswith('/v1/'):
+        return
+    g.metrics = dict(
+        started=time.time(),
+        queries=0, db_time=0,
+        http_calls=0, http_time=0,
+    )
+
+
+def after_request(response):
+    counters = _counters()
+    if not counters:
+        return response
+    spent = time.time() - counters['started']
+    endpoint = request.endpoint or 'unknown'
+    _stats.setdefault(endpoint, EndpointStats()).add(spent, counters)
+
+    from .helpers import dd_stat # avoid cyclic import
+    tags = ['endpoint:' + endpoint, 'method:' + request.method]
+    dd_stat.histogram('request.time', spent, tags=tags)
+    dd_stat.histogram('request.queries', counters['queries'], tags=tags)
+    dd_stat.histogram('request.db_time', counters['db_time'], tags=tags)
+    if counters['http_calls']:
+        dd_stat.histogram('request.http_calls', counters['http_calls'],
+                          tags=tags)
+        dd_stat.histogram('request.http_time', counters['http_time'],
+                          tags=tags)
+
+    if (config.QUERY_COUNT_THRESHOLD and
+            counters['queries'] > config.QUERY_COUNT_THRESHOLD):
+        log.warning('{} {} ({}) ran {} queries in {:.1f} ms'.format(
+            request.method, request.path, endpoint,
+            counters['queries'], counters['db_time'] * 1000))
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters,
+                           context, executemany):
+    if context is not None and _counters():
+        context._metrics_started = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters,
+                          context, executemany):
+    counters = _counters()
+    started = getattr(context, '_metrics_started', None)
+    if counters and started:
+        counters['queries'] += 1
+        counters['db_time'] += time.time() - started
+
+
+_orig_send = requests.Session.send
+def _send(self, *args, **kwargs):
+    counters = _counters()
+    if not counters:
+        return _orig_send(self, *args, **kwargs)
+    started = time.time()
+    try:
+        return _orig_send(self, *args, **kwargs)
+    finally:
+        counters['http_calls'] += 1
+        counters['http_time'] += time.time() - started
+
+
+def summary():
+    """
+    Aggregated stats of this process as a list, slowest endpoints first.
+    """
+    ret = []
+    for endpoint, stats in _stats.items():
+        item = OrderedDict(endpoint=endpoint)
+        item.update(stats.summary())
+        ret.append(item)
+    ret.sort(key=lambda item: -item['avg_ms'])
+    return ret
+
+
+def init_app(flask_app):
+    flask_app.before_request(before_request)
+    flask_app.after_request(after_request)
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    # requests.get/post and sessions all go through Session.send
+    if requests.Session.send is _orig_send:
+        requests.Session.send = _send
@@ -1,13 +1,15 @@
 from datetime import datetime, timedelta
+from collections import OrderedDict
 
-from sqlalchemy import or_, case, and_
+from sqlalchemy import or_, case, and_, event, inspect, select
 from sqlalchemy.orm import deferred, undefer_group, undefer, attributes
+from sqlalchemy.orm import Session
 from sqlalchemy.sql.expression import func
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 
 from flask import g
 
-from .main import db
+from .main import db, redis
 from .common import *
 
 from v1.badges import BADGES, Fifa15Badges
@@ -19,7 +21,7 @@ class Player(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nickname = db.Column(db.String(64), unique=True)
     email = db.Column(db.String(128), nullable=True, unique=True)
-    password = db.Column(db.LargeBinary(36))
+    password = db.Column(db.LargeBinary(64))
     facebook_id = db.Column(db.String(64))
     facebook_token = db.Column(db.String(128))
     twitter_id = db.Column(db.Integer)
@@ -28,6 +30,10 @@ class Player(db.Model):
     williamhill_token = db.Column(db.String(128))
     # williamhill_currency = db.Column(db.String(3)) # TODO handle&save it?
     create_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # maintained by UserpicResource
+    userpic_ext = db.Column(db.String(8), nullable=True)
+    userpic_version = db.Column(db.Integer, nullable=False, default=0,
+                                server_default='0')
     bio = db.Column(db.Text)
 
     ea_gamertag = db.Column(db.String(64), unique=True)
@@ -44,6 +50,10 @@ class Player(db.Model):
     def __init__(self):
         self.badges = Badges()
         db.session.add(self.badges)
+        # every player has totals row, so that leaderboard can use inner join
+        stats = PlayerStats()
+        stats.player = self
+        db.session.add(stats)
 
     def report_for_game(self, game_id):
         return Report.query.filter(Report.game_id == game_id, Report.player_id == self.id).first()
@@ -89,19 +99,27 @@ class Player(db.Model):
 
     @hybrid_method
     def winrate_impl(self, *filters):
-        count = 0
-        wins = 0
-        for game in self.games.filter(Game.state == 'finished', *filters):
-            count += 1
-            whoami = 'creator' if game.creator_id == self.id else 'opponent'
-            if game.winner == 'draw':
-                wins += 0.5
-            elif game.winner == whoami:
-                wins += 1
+        if not filters:
+            # unfiltered winrate is already calculated
+            stats = PlayerStats.query.get((self.id, PlayerStats.ALL))
+            if stats:
+                return stats.winrate
+        count, wins, draws = self.games.filter(
+            Game.state == 'finished', *filters
+        ).with_entities(
+            func.count(Game.id),
+            func.sum(case([
+                (and_(Game.creator_id == self.id,
+                      Game.winner == 'creator'), 1),
+                (and_(Game.opponent_id == self.id,
+                      Game.winner == 'opponent'), 1),
+            ], else_=0)),
+            func.sum(case([(Game.winner == 'draw', 1)], else_=0)),
+        ).one()
         if count == 0:
             # no finished games, no data
             return None
-        return wins / count
+        return (int(wins) + int(draws) / 2) / count
 
     @hybrid_property
     def mygames(cls):
@@ -209,34 +227,86 @@ class Player(db.Model):
             return self.winrate_impl(*g.winrate_filt)
         return self.winrate_impl()
 
+    # Buckets are aligned to epoch, so that past buckets never change
+    # and can be cached; the latest bucket is the one containing now.
+    _winratehist_epoch = datetime(1970, 1, 1)
+
+    def _winratehist_key(self, seconds):
+        return '{}.winratehist.{}.{}'.format(
+            'test' if config.TEST else 'prod', self.id, seconds)
+
+    def reset_winratehist(self):
+        """
+        Drop cached winratehist buckets;
+        should be called when player's game gets finished.
+        """
+        redis.delete(*[
+            self._winratehist_key(int(timedelta(days=days).total_seconds()))
+            for days in (1, 7, 30.5)
+        ])
+
     # @hybrid_method
-    def winratehist(self, days=None, weeks=None, months=None):
+    def winratehist(self, days=None, weeks=None, months=None, cache=True):
+        """
+        Returns list of (bucket start, games, wins, winrate),
+        most recent bucket first. Draws count as half of win.
+        """
         count = days or weeks or months
         if not count:
             raise ValueError('Please provide something!')
         # 30.5 is approximate number of days in month
         delta = timedelta(days=1 if days else 7 if weeks else 30.5)
-        now = datetime.utcnow()
+        seconds = int(delta.total_seconds())
+        epoch = self._winratehist_epoch
+        current = int((datetime.utcnow() - epoch).total_seconds() // seconds)
+        first = current - count + 1
+
+        # closed buckets: bucket -> (games, wins, draws)
+        buckets = {}
+        key = self._winratehist_key(seconds)
+        if cache:
+            for k, v in redis.hgetall(key).items():
+                buckets[int(k)] = tuple(map(int, v.split(b':')))
+        missing = [k for k in range(first, current) if k not in buckets]
+        since = min(missing) if missing else current
+
+        bucket = func.floor(
+            func.timestampdiff(db.text('SECOND'), epoch, Game.finish_date)
+            / seconds
+        )
+        rows = db.session.query(
+            bucket,
+            func.count(Game.id),
+            func.sum(case([
+                (and_(Game.winner == 'creator',
+                      Game.creator_id == self.id), 1),
+                (and_(Game.winner == 'opponent',
+                      Game.opponent_id == self.id), 1),
+            ], else_=0)),
+            func.sum(case([(Game.winner == 'draw', 1)], else_=0)),
+        ).filter(
+            or_(Game.creator_id == self.id, Game.opponent_id == self.id),
+            Game.state == 'finished',
+            Game.finish_date >= epoch + delta * since,
+        ).group_by(bucket)
+        fresh = {k: (0, 0, 0) for k in range(since, current + 1)}
+        for k, total, wins, draws in rows:
+            fresh[int(k)] = (int(total), int(wins or 0), int(draws or 0))
+        buckets.update(fresh)
+
+        if cache and missing:
+            redis.hmset(key, {
+                k: '{}:{}:{}'.format(*v)
+                for k, v in fresh.items() if k < current
+            })
+            redis.expire(key, seconds * (count + 1))
+
         ret = []
-        for i in range(count):
-            prev = now - delta
-
-            count, wins = 0, 0
-            for game in self.games.filter(
-                            Game.state == 'finished',
-                            Game.finish_date > prev,
-                            Game.finish_date <= now,
-            ):
-                count += 1
-                whoami = 'creator' if game.creator_id == self.id else 'opponent'
-                if game.winner == 'draw':
-                    wins += 0.5
-                elif game.winner == whoami:
-                    wins += 1
-            rate = (wins / count) if count else 0
-
-            ret.append((prev, count, wins, rate))
-            now = prev
+        for k in range(current, first - 1, -1):
+            total, wins, draws = buckets[k]
+            wins += draws / 2
+            rate = (wins / total) if total else 0
+            ret.append((epoch + delta * k, total, wins, rate))
         return ret
 
     @hybrid_property
@@ -286,35 +356,20 @@ class Player(db.Model):
     def popularity(self):
         return self.popularity_impl()  # without filters
 
-    _leadercache = {}  # is a class field
-    _leadercachetime = None
-
     @property
     def leaderposition(self):
-        if not self._leadercache or self._leadercachetime < datetime.utcnow():
-            self._leadercachetime = datetime.utcnow() + \
-                                    timedelta(minutes=5)
-            self._leadercache = {}
-            # This is dirty way, but "db-related" one did not work..
-            # http://stackoverflow.com/questions/7057772/get-row-position-in-mysql-query
-            # MySQL kept ordering line numbers according to ID,
-            # regardless of ORDER BY clause.
-            # Maybe because of joins or so.
-
-            # TODO: maybe cache result in memory for e.g. 5min
-            q = Player.query.with_entities(
-                Player.id,
-            ).order_by(
-                # FIXME: hardcoded algorithm is not a good thing?
-                Player.winrate.desc(),
-                Player.gamecount.desc(),
-                Player.id.desc(),
-            )
-            self._leadercache = {
-                row[0]: n + 1
-                for n, row in enumerate(q)
-            }
-        return self._leadercache[self.id]
+        # Rank index is kept in redis and updated along with PlayerStats,
+        # so this is just a ZREVRANK and is consistent across workers.
+        member = PlayerStats.rank_member(self.id)
+        rank = redis.zrevrank(PlayerStats.RANK_KEY, member)
+        if rank is None:
+            # not indexed yet - probably a new player
+            stats = PlayerStats.query.get((self.id, PlayerStats.ALL))
+            if not stats:
+                return None
+            stats.update_rank()
+            rank = redis.zrevrank(PlayerStats.RANK_KEY, member)
+        return rank + 1
 
     @hybrid_property
     def recent_opponents(self):
@@ -335,9 +390,7 @@ class Player(db.Model):
 
     @property
     def has_userpic(self):
-        from .routes import UserpicResource
-
-        return bool(UserpicResource.findfile(self))
+        return bool(self.userpic_ext)
 
     _identities = [
         'nickname',
@@ -364,16 +417,68 @@ class Player(db.Model):
         if '@' in key and '.' in key:
             return cls.query.filter_by(email=key).first()
 
-        p = None
+        fields = ['id'] + cls._identities
         try:
-            p = cls.query.get(int(key))
+            conditions = [cls.id == int(key)]
         except ValueError:
-            pass
-        for identity in cls._identities:
-            if p:
-                return p
-            p = cls.query.filter_by(**{identity: key}).first()
-        return p
+            fields = cls._identities
+            conditions = []
+
+        # Only matches on the top priority field are cached:
+        # for lower ones, a better match could appear at any time.
+        cache_key = (fields[0], key)
+        cached = cls._find_cache.get(cache_key)
+        if cached:
+            player_id, expires = cached
+            if expires > datetime.utcnow():
+                p = cls.query.get(player_id)
+                # identity could be changed by another worker, so validate it
+                if p and cls._find_matches(p, fields[0], key):
+                    try:
+                        cls._find_cache.move_to_end(cache_key)
+                    except KeyError:
+                        pass # evicted by another greenlet meanwhile
+                    return p
+            cls._find_cache.pop(cache_key, None)
+
+        conditions.extend(getattr(cls, identity) == key
+                          for identity in cls._identities)
+        candidates = cls.query.filter(or_(*conditions)).all()
+        # id has priority over identities, identities are tried in order
+        for field in fields:
+            for p in candidates:
+                if cls._find_matches(p, field, key):
+                    if field == fields[0]:
+                        cls._find_cache[cache_key] = (
+                            p.id, datetime.utcnow() + cls._find_cache_ttl)
+                        if len(cls._find_cache) > cls._find_cache_max:
+                            # remove oldest item
+                            cls._find_cache.popitem(last=False)
+                    return p
+        return None
+
+    # (matched field, lookup key) -> (player id, expiration time)
+    _find_cache = OrderedDict()
+    _find_cache_max = 1000
+    _find_cache_ttl = timedelta(minutes=10)
+
+    @staticmethod
+    def _find_matches(player, field, key):
+        value = getattr(player, field)
+        if field == 'id':
+            return str(value) == str(int(key))
+        # mysql comparison is case-insensitive, so match it
+        return value is not None and str(value).lower() == key.lower()
+
+    @classmethod
+    def forget_find(cls, player):
+        """
+        Drop cached `find` results for given player;
+        should be called when player's identities change.
+        """
+        for key, cached in list(cls._find_cache.items()):
+            if cached[0] == player.id:
+                cls._find_cache.pop(key, None)
 
     @classmethod
     def find_or_fail(cls, key):
@@ -383,22 +488,26 @@ class Player(db.Model):
         return player
 
     @classmethod
-    def search(cls, filt, operation='like'):
+    def search(cls, filt, operation='startswith'):
         """
-        Filt should be suitable for SQL LIKE statement.
-        E.g. "word%" will search anything starting with word.
+        Find players any of whose identities either starts with
+        or contains given text, case-insensitive.
+        Operation is either `startswith` or `contains`.
+        Uses PlayerSearchToken index rather than scanning player table.
         """
         if len(filt) < 1:
             return []
-        return cls.query.filter(
-            or_(*[
-                getattr(
-                    getattr(cls, identity),
-                    operation,
-                )(filt)
-                for identity in cls._identities
-            ])
+        text = PlayerSearchToken.normalize(filt)
+        for c in '\\%_':
+            text = text.replace(c, '\\' + c)
+        matches = db.session.query(PlayerSearchToken.player_id).filter(
+            PlayerSearchToken.token.like(text + '%', escape='\\'),
         )
+        if operation == 'startswith':
+            matches = matches.filter(PlayerSearchToken.position == 0)
+        elif operation != 'contains':
+            raise ValueError('Unknown operation ' + operation)
+        return cls.query.filter(cls.id.in_(matches))
 
     def __repr__(self):
         return '<Player id={} nickname={} balance={}>'.format(
@@ -858,10 +967,24 @@ class Game(db.Model):
                           index=True)
     parent = db.relationship('Game', foreign_keys='Game.parent_id',
                              backref='children', remote_side='Game.id')
+    # denormalized root of game session, NULL for root game itself;
+    # maintained automatically when parent is set
+    root_id = db.Column(db.Integer, db.ForeignKey('game.id'), index=True)
+    session_root = db.relationship('Game', foreign_keys='Game.root_id',
+                                   remote_side='Game.id')
+
+    @db.validates('parent')
+    def validate_parent(self, key, parent):
+        self.session_root = parent.root if parent else None
+        return parent
 
     gamertag_creator = db.Column(db.String(128))
     gamertag_opponent = db.Column(db.String(128))
     twitch_handle = db.Column(db.String(128))
+    # maintained by GameMessageResource
+    message_ext = db.Column(db.String(8), nullable=True)
+    message_version = db.Column(db.Integer, nullable=False, default=0,
+                                server_default='0')
     twitch_identity_creator = db.Column(db.String(128))
     twitch_identity_opponent = db.Column(db.String(128))
 
@@ -886,19 +1009,33 @@ class Game(db.Model):
     tournament_id = db.Column(db.Integer(), db.ForeignKey(Tournament.id), index=True, nullable=True)
     tournament = db.relationship(Tournament, backref='games')
 
+    # gametype -> GametypeDescriptor, registered by polling module
+    _descriptors = {}
+
+    @classmethod
+    def register_gametypes(cls, descriptors):
+        cls._descriptors.update(descriptors)
+
+    @property
+    def descriptor(self):
+        """
+        Resolved per-gametype data (poller, identities, ingame modes),
+        or None for unknown gametype.
+        """
+        if not self._descriptors:
+            from . import polling  # noqa - it will register gametypes
+        return self._descriptors.get(self.gametype)
+
     def _make_identity_getter(kind, prop):
-        def _getter(self):
-            if not self.gametype:
-                return None
-            from .polling import Poller
+        name = '_'.join((kind, prop))
 
-            poller = Poller.findPoller(self.gametype)
-            identity = getattr(poller, kind)
-            if not identity:
+        def _getter(self):
+            descriptor = self.descriptor
+            if not descriptor:
                 return None
-            return getattr(identity, prop)
+            return getattr(descriptor, name)
 
-        _getter.__name__ = '_'.join((kind, prop))
+        _getter.__name__ = name
         return _getter
 
     for kind in 'identity', 'twitch_identity':
@@ -916,8 +1053,12 @@ class Game(db.Model):
         seq = {'val': 0, 'text': 1}[prop]
 
         def _getter(self):
+            value = getattr(self, attr)
+            descriptor = self.descriptor
+            if value is None or not descriptor:
+                return value
             # formatter returns tuple (internal, human_readable)
-            return self.identity.formatter(getattr(self, attr))[seq]
+            return descriptor.formatter(value)[seq]
 
         return _getter
 
@@ -933,29 +1074,29 @@ class Game(db.Model):
         """
         Returns true if this game is session starter
         """
-        return not bool(self.parent)
+        return self.root_id is None and not self.parent
 
     @property
     def root(self):
         """
         Returns root game for this game
         """
-        if not self.parent:
-            return self
-        return self.parent.root
+        if self.session_root:
+            return self.session_root
+        if self.parent:
+            # not backfilled yet
+            return self.parent.root
+        return self
 
     @property
     def has_message(self):
-        from .routes import GameMessageResource
-
-        return bool(GameMessageResource.findfile(self))
+        return bool(self.message_ext)
 
     @property
     def is_ingame(self):
-        from .polling import Poller
-
-        return (self.gamemode in
-                Poller.findPoller(self.gametype).gamemodes_ingame)
+        descriptor = self.descriptor
+        return bool(descriptor) and (
+            self.gamemode in descriptor.gamemodes_ingame)
 
     @hybrid_method
     def is_game_player(self, player):
@@ -980,6 +1121,523 @@ class Game(db.Model):
         return '<Game id={} state={}>'.format(self.id, self.state)
 
 
+class GameCounters:
+    """
+    Game counters shared by PlayerStats and PlayerDailyStats.
+    """
+    ALL = ''  # gametype value for rows which hold totals for all gametypes
+
+    # leaderboard order name -> column name
+    ORDERS = dict(
+        winrate='winrate',
+        gamecount='games',
+        popularity='accepted',
+    )
+
+    # all games regardless of their state, like Player.gamecount
+    games = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    wins = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    draws = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    losses = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # games which are currently in `accepted` state, like Player.popularity
+    accepted = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    def reset_counters(self):
+        # column defaults are only applied on insert, but we need them now
+        self.games = self.wins = self.draws = self.losses = self.accepted = 0
+
+    @property
+    def finished(self):
+        return self.wins + self.draws + self.losses
+
+    def calc_winrate(self):
+        if not self.finished:
+            return None
+        return (self.wins + self.draws / 2) / self.finished
+
+    COUNTERS = ('games', 'wins', 'draws', 'losses', 'accepted')
+
+    @staticmethod
+    def transition_deltas(game, role, old_state):
+        """
+        Returns counter changes caused by game state change,
+        as dict of column name -> delta.
+        """
+        deltas = {}
+        if old_state == 'accepted':
+            deltas['accepted'] = -1
+        if game.state == 'accepted':
+            deltas['accepted'] = deltas.get('accepted', 0) + 1
+        if game.state == 'finished' and old_state != 'finished':
+            if game.winner == 'draw':
+                deltas['draws'] = 1
+            elif game.winner == role:
+                deltas['wins'] = 1
+            else:
+                deltas['losses'] = 1
+        return deltas
+
+    def count_transition(self, game, role, old_state):
+        for col, delta in self.transition_deltas(
+                game, role, old_state).items():
+            setattr(self, col, getattr(self, col) + delta)
+
+    @classmethod
+    def increment(cls, key, changes):
+        """
+        Atomically apply counter deltas to the row with given primary key,
+        creating it if missing, with INSERT ... ON DUPLICATE KEY UPDATE.
+        Web workers and poller update the same rows concurrently,
+        so they must never read-modify-write counters in Python.
+        """
+        values = dict(key)
+        values.update({col: changes.get(col, 0) for col in cls.COUNTERS})
+        updates = [
+            '{0} = {0} + VALUES({0})'.format(col)
+            for col in cls.COUNTERS if changes.get(col)
+        ]
+        cls._increment_extra(values, updates, changes)
+        if not updates:
+            return
+        columns = list(values)
+        db.session.execute(
+            'INSERT INTO {} ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {}'
+            .format(
+                cls.__tablename__,
+                ', '.join(columns),
+                ', '.join(':' + col for col in columns),
+                # MySQL applies these left to right,
+                # so later ones see updated counters
+                ', '.join(updates),
+            ), values)
+
+    @classmethod
+    def _increment_extra(cls, values, updates, changes):
+        """
+        Hook for subclasses with non-counter columns.
+        """
+        pass
+
+    @staticmethod
+    def _game_players(game):
+        for role in 'creator', 'opponent':
+            player_id = getattr(game, role + '_id') or getattr(
+                getattr(game, role), 'id', None)
+            if player_id:
+                yield role, player_id
+
+
+class PlayerStats(GameCounters, db.Model):
+    """
+    Materialized per-player game statistics.
+    It is maintained incrementally on each game state change,
+    so that leaderboard doesn't need to scan game table.
+    Row with empty gametype (`ALL`) holds totals for all gametypes.
+    """
+    __tablename__ = 'player_stats'
+
+    ORDERS = dict(GameCounters.ORDERS, lastbet='lastbet')
+
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'),
+                          primary_key=True)
+    player = db.relationship(Player, backref=db.backref('stats',
+                                                        lazy='dynamic'))
+    gametype = db.Column(db.String(64), primary_key=True)
+
+    lastbet = db.Column(db.DateTime, nullable=True)
+    # stored rather than calculated to make it indexable;
+    # NULL if there are no finished games
+    winrate = db.Column(db.Float, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_player_stats_winrate', 'gametype', 'winrate', 'games'),
+        db.Index('ix_player_stats_games', 'gametype', 'games'),
+        db.Index('ix_player_stats_accepted', 'gametype', 'accepted'),
+        db.Index('ix_player_stats_lastbet', 'gametype', 'lastbet'),
+    )
+
+    # Redis sorted set used as leaderboard rank index.
+    # It only includes totals rows.
+    RANK_KEY = '{}.leaderboard'.format('test' if config.TEST else 'prod')
+    RANK_PENDING = 'rank_players' # session.info key
+
+    def __init__(self, player_id=None, gametype=GameCounters.ALL):
+        self.player_id = player_id
+        self.gametype = gametype
+        self.reset_counters()
+
+    @staticmethod
+    def rank_member(player_id):
+        # Members with equal score are ordered lexicographically,
+        # so zero-padded id gives us id tie-break for free.
+        return '{:010d}'.format(player_id)
+
+    @staticmethod
+    def score(winrate, games):
+        """
+        Score which orders the same way as the leaderboard:
+        by winrate, then by games count; players without finished games last.
+        Winrate is quantized to 20 bits and games count takes lower 32 bits,
+        which fits into double mantissa.
+        """
+        if winrate is None:
+            return games - 2**32
+        return round(winrate * 2**20) * 2**32 + games
+
+    @property
+    def rank_score(self):
+        return self.score(self.winrate, self.games)
+
+    def update_rank(self):
+        if self.gametype != self.ALL or not self.player_id:
+            return
+        redis.zadd(self.RANK_KEY,
+                   **{self.rank_member(self.player_id): self.rank_score})
+
+    @classmethod
+    def refresh_ranks_later(cls, player_ids):
+        """
+        Schedule rank index update for given players
+        once current transaction is committed,
+        so that rolled back changes never reach Redis.
+        """
+        db.session.info.setdefault(
+            cls.RANK_PENDING, set()).update(player_ids)
+
+    @classmethod
+    def refresh_ranks(cls, player_ids):
+        """
+        Put committed totals of given players to rank index.
+        Doesn't use session, as it is called when session
+        has no transaction.
+        """
+        table = cls.__table__
+        rows = db.engine.execute(select([
+            table.c.player_id, table.c.winrate, table.c.games,
+        ]).where(and_(
+            table.c.gametype == cls.ALL,
+            table.c.player_id.in_(player_ids),
+        ))).fetchall()
+        if rows:
+            redis.zadd(cls.RANK_KEY, **{
+                cls.rank_member(player_id): cls.score(winrate, games)
+                for player_id, winrate, games in rows
+            })
+
+    @classmethod
+    def rebuild_ranks(cls):
+        """
+        Recreate rank index from totals rows.
+        New index is built aside and then swapped in atomically.
+        """
+        tmp_key = cls.RANK_KEY + '.rebuild'
+        redis.delete(tmp_key)
+        pipe = redis.pipeline()
+        count = 0
+        for row in cls.query.filter_by(gametype=cls.ALL).yield_per(1000):
+            pipe.zadd(tmp_key,
+                      **{cls.rank_member(row.player_id): row.rank_score})
+            count += 1
+            if count % 1000 == 0:
+                pipe.execute()
+        pipe.execute()
+        if count:
+            redis.rename(tmp_key, cls.RANK_KEY)
+        else:
+            redis.delete(cls.RANK_KEY)
+        return count
+
+    def count_created(self, game):
+        self.games += 1
+        date = game.create_date or datetime.utcnow()
+        if not self.lastbet or self.lastbet < date:
+            self.lastbet = date
+
+    def count_transition(self, game, role, old_state):
+        super().count_transition(game, role, old_state)
+        self.winrate = self.calc_winrate()
+
+    @classmethod
+    def _increment_extra(cls, values, updates, changes):
+        values['lastbet'] = changes.get('lastbet')
+        if values['lastbet']:
+            updates.append('lastbet = GREATEST('
+                           'COALESCE(lastbet, VALUES(lastbet)), '
+                           'VALUES(lastbet))')
+        finished = values['wins'] + values['draws'] + values['losses']
+        values['winrate'] = ((values['wins'] + values['draws'] / 2) / finished
+                             if finished else None)
+        if any(changes.get(col) for col in ('wins', 'draws', 'losses')):
+            updates.append('winrate = IF(wins + draws + losses = 0, NULL, '
+                           '(wins + draws / 2) / (wins + draws + losses))')
+
+    @classmethod
+    def increment_rows(cls, player_id, gametype, changes):
+        """
+        Apply changes to totals row and gametype row of given player.
+        """
+        for gt in cls.ALL, gametype:
+            cls.increment(dict(player_id=player_id, gametype=gt), changes)
+
+    @classmethod
+    def game_created(cls, game):
+        """
+        Should be called for newly created game before commit.
+        """
+        db.session.flush() # for pending players and their stats rows
+        changes = dict(games=1,
+                       lastbet=game.create_date or datetime.utcnow())
+        player_ids = []
+        for role, player_id in cls._game_players(game):
+            cls.increment_rows(player_id, game.gametype, changes)
+            player_ids.append(player_id)
+        cls.refresh_ranks_later(player_ids)
+
+    @classmethod
+    def game_state_changed(cls, game, old_state):
+        """
+        Should be called after game state was changed, before commit.
+        Also maintains PlayerDailyStats.
+        """
+        if game.state == old_state:
+            return
+        db.session.flush()
+        day = game.accept_date.date() if game.accept_date else None
+        player_ids = []
+        for role, player_id in cls._game_players(game):
+            deltas = cls.transition_deltas(game, role, old_state)
+            cls.increment_rows(player_id, game.gametype, deltas)
+            player_ids.append(player_id)
+            if day:
+                daily = dict(deltas)
+                if old_state == 'new':
+                    daily['games'] = daily.get('games', 0) + 1
+                PlayerDailyStats.increment_rows(
+                    player_id, game.gametype, day, daily)
+        cls.refresh_ranks_later(player_ids)
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recalculate all statistics from scratch,
+        including PlayerDailyStats.
+        """
+        cls.query.delete()
+        PlayerDailyStats.query.delete()
+        rows = {}
+
+        def row(model, player_id, *key):
+            key = (model, player_id) + key
+            if key not in rows:
+                rows[key] = model(player_id, *key[2:])
+            return rows[key]
+
+        for player_id, in db.session.query(Player.id):
+            row(cls, player_id, cls.ALL)
+        for game in Game.query.yield_per(1000):
+            for role, player_id in cls._game_players(game):
+                for gt in cls.ALL, game.gametype:
+                    r = row(cls, player_id, gt)
+                    r.count_created(game)
+                    r.count_transition(game, role, 'new')
+                    if game.accept_date and game.state != 'new':
+                        r = row(PlayerDailyStats, player_id, gt,
+                                game.accept_date.date())
+                        r.games += 1
+                        r.count_transition(game, role, 'new')
+        db.session.add_all(rows.values())
+        db.session.commit()
+        cls.rebuild_ranks()
+        return len(rows)
+
+    def __repr__(self):
+        return '<PlayerStats player_id={} gametype={} games={}>'.format(
+            self.player_id, self.gametype, self.games)
+
+
+class PlayerDailyStats(GameCounters, db.Model):
+    """
+    Per-player game counters bucketed by day of game acceptance
+    (which is what period leaderboards filter on).
+    Games which were never accepted or declined are not counted here.
+    Maintained along with PlayerStats.
+    """
+    __tablename__ = 'player_daily_stats'
+
+    PERIODS = dict(
+        # name: (first day, last day) as days ago, inclusive
+        today=(0, 0),
+        yesterday=(1, 1),
+        week=(6, 0),
+        month=(29, 0),
+    )
+
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'),
+                          primary_key=True)
+    gametype = db.Column(db.String(64), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+
+    __table_args__ = (
+        db.Index('ix_player_daily_stats_day', 'gametype', 'day', 'player_id'),
+    )
+
+    def __init__(self, player_id=None, gametype=GameCounters.ALL, day=None):
+        self.player_id = player_id
+        self.gametype = gametype
+        self.day = day
+        self.reset_counters()
+
+    @classmethod
+    def increment_rows(cls, player_id, gametype, day, changes):
+        """
+        Apply changes to totals row and gametype row of given player and day.
+        """
+        for gt in cls.ALL, gametype:
+            cls.increment(dict(player_id=player_id, gametype=gt, day=day),
+                          changes)
+
+    @classmethod
+    def period_range(cls, period):
+        """
+        Returns (first, last) days of the period, inclusive.
+        """
+        today = datetime.utcnow().date()
+        since, till = cls.PERIODS[period]
+        return today - timedelta(days=since), today - timedelta(days=till)
+
+    @classmethod
+    def period_totals(cls, period, gametype=GameCounters.ALL):
+        """
+        Returns subquery with per-player sums over given period,
+        with columns player_id, games, accepted and winrate.
+        """
+        since, till = cls.period_range(period)
+        finished = func.sum(cls.wins + cls.draws + cls.losses)
+        return db.session.query(
+            cls.player_id.label('player_id'),
+            func.sum(cls.games).label('games'),
+            func.sum(cls.accepted).label('accepted'),
+            case([
+                (finished == 0, None),
+            ], else_=(
+                (func.sum(cls.wins) + func.sum(cls.draws) / 2) / finished
+            )).label('winrate'),
+        ).filter(
+            cls.gametype == gametype,
+            cls.day >= since,
+            cls.day <= till,
+        ).group_by(cls.player_id).subquery()
+
+    def __repr__(self):
+        return '<PlayerDailyStats player_id={} gametype={} day={}>'.format(
+            self.player_id, self.gametype, self.day)
+
+
+class PlayerSearchToken(db.Model):
+    """
+    Search index for player identities.
+    For every identity value we store all its casefolded suffixes,
+    so both "starts with" (suffix at position 0)
+    and "contains" (any suffix) searches become
+    index range scans of `token LIKE 'text%'`.
+    Maintained by mapper events on Player.
+    """
+    __tablename__ = 'player_search_token'
+
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'),
+                          primary_key=True)
+    identity = db.Column(db.String(32), primary_key=True)
+    position = db.Column(db.SmallInteger, primary_key=True)
+    token = db.Column(db.String(128), nullable=False, index=True)
+
+    __table_args__ = (
+        db.Index('ix_player_search_token_prefix', 'position', 'token'),
+    )
+
+    @staticmethod
+    def normalize(value):
+        return str(value).casefold()
+
+    @classmethod
+    def tokens(cls, value):
+        value = cls.normalize(value)
+        return [
+            (pos, value[pos:pos+128])
+            for pos in range(len(value))
+        ]
+
+    @classmethod
+    def reindex(cls, connection, player_id, identities):
+        """
+        Replace index entries for given identities (a name->value dict)
+        of given player. Uses plain connection, as it is called during flush.
+        """
+        table = cls.__table__
+        connection.execute(table.delete().where(and_(
+            table.c.player_id == player_id,
+            table.c.identity.in_(list(identities)),
+        )))
+        rows = [
+            dict(player_id=player_id, identity=identity,
+                 position=pos, token=token)
+            for identity, value in identities.items() if value
+            for pos, token in cls.tokens(value)
+        ]
+        if rows:
+            connection.execute(table.insert(), rows)
+
+    @classmethod
+    def rebuild(cls):
+        connection = db.session.connection()
+        connection.execute(cls.__table__.delete())
+        count = 0
+        for player in Player.query.yield_per(1000):
+            cls.reindex(connection, player.id, {
+                identity: getattr(player, identity)
+                for identity in Player._identities
+            })
+            count += 1
+        db.session.commit()
+        return count
+
+
+@event.listens_for(Player, 'after_insert')
+def _player_search_insert(mapper, connection, player):
+    PlayerSearchToken.reindex(connection, player.id, {
+        identity: getattr(player, identity)
+        for identity in Player._identities
+    })
+
+
+@event.listens_for(Player, 'after_update')
+def _player_search_update(mapper, connection, player):
+    state = inspect(player)
+    changed = {
+        identity: getattr(player, identity)
+        for identity in Player._identities
+        if state.attrs[identity].history.has_changes()
+    }
+    if changed:
+        PlayerSearchToken.reindex(connection, player.id, changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _stats_ranks_commit(session):
+    player_ids = session.info.pop(PlayerStats.RANK_PENDING, None)
+    if not player_ids:
+        return
+    try:
+        PlayerStats.refresh_ranks(player_ids)
+    except Exception:
+        # data is committed already; index can be fixed by rebuild_ranks
+        log.exception('Failed to update rank index')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _stats_ranks_rollback(session):
+    session.info.pop(PlayerStats.RANK_PENDING, None)
+
+
 class ChatMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('player.id'), index=True)
@@ -1030,6 +1688,134 @@ class ChatMessage(db.Model):
         return '<ChatMessage id={} text={}>'.format(self.id, self.text)
 
 
+class Conversation(db.Model):
+    """
+    Inbox projection of player-to-player messages
+    (i.e. not related to games or tickets).
+    There is one row for each side of each conversation,
+    maintained by ChatMessageResource.
+    """
+    PREVIEW_LENGTH = 128
+
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'),
+                          nullable=False)
+    player = db.relationship(Player, foreign_keys='Conversation.player_id')
+    other_id = db.Column(db.Integer, db.ForeignKey('player.id'),
+                         nullable=False)
+    other = db.relationship(Player, foreign_keys='Conversation.other_id')
+
+    last_message_id = db.Column(db.Integer, db.ForeignKey('chat_message.id'))
+    last_message = db.relationship(ChatMessage)
+    last_time = db.Column(db.DateTime)
+    preview = db.Column(db.String(PREVIEW_LENGTH))
+    unread = db.Column(db.Integer, nullable=False, default=0,
+                       server_default='0')
+
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'other_id'),
+        db.Index('ix_conversation_inbox', 'player_id', 'last_time', 'id'),
+    )
+
+    @staticmethod
+    def is_tracked(msg):
+        return not (msg.game_id or msg.game or msg.ticket_id or msg.ticket or
+                    msg.admin_message)
+
+    @classmethod
+    def upsert(cls, player_id, other_id, msg, unread):
+        """
+        Make given message the last one of conversation,
+        creating it if missing, and add `unread` to its counter.
+        Uses INSERT ... ON DUPLICATE KEY UPDATE like GameCounters.increment,
+        as messages between the same players can be posted concurrently.
+        """
+        db.session.execute(
+            'INSERT INTO conversation '
+            '(player_id, other_id, last_message_id, last_time, preview, unread) '
+            'VALUES (:player_id, :other_id, :last_message_id, :last_time, '
+            ':preview, :unread) '
+            'ON DUPLICATE KEY UPDATE '
+            # MySQL applies these left to right, so last_message_id goes last;
+            # an older message which was committed later doesn't win
+            'last_time = IF(last_message_id > VALUES(last_message_id), '
+            'last_time, VALUES(last_time)), '
+            'preview = IF(last_message_id > VALUES(last_message_id), '
+            'preview, VALUES(preview)), '
+            'last_message_id = GREATEST(COALESCE(last_message_id, 0), '
+            'VALUES(last_message_id)), '
+            'unread = unread + VALUES(unread)',
+            dict(
+                player_id=player_id,
+                other_id=other_id,
+                last_message_id=msg.id,
+                last_time=msg.time or datetime.utcnow(),
+                preview=(msg.text or '')[:cls.PREVIEW_LENGTH],
+                unread=unread,
+            ))
+
+    def set_last(self, msg):
+        self.last_message = msg
+        self.last_time = msg.time or datetime.utcnow()
+        self.preview = (msg.text or '')[:self.PREVIEW_LENGTH]
+
+    @classmethod
+    def message_posted(cls, msg):
+        """
+        Should be called for new message, before commit.
+        """
+        if not cls.is_tracked(msg):
+            return
+        db.session.flush() # for message id
+        cls.upsert(msg.sender.id, msg.receiver.id, msg, 0)
+        cls.upsert(msg.receiver.id, msg.sender.id, msg,
+                   0 if msg.viewed else 1)
+
+    @classmethod
+    def message_viewed(cls, msg, was_viewed):
+        """
+        Should be called when `viewed` flag of message is changed.
+        """
+        if not cls.is_tracked(msg) or bool(was_viewed) == bool(msg.viewed):
+            return
+        conv = cls.query.filter_by(player_id=msg.receiver_id,
+                                   other_id=msg.sender_id).first()
+        if not conv:
+            return
+        if msg.viewed:
+            conv.unread = max(conv.unread - 1, 0)
+        else:
+            conv.unread += 1
+
+    @classmethod
+    def rebuild(cls):
+        cls.query.delete()
+        convs = {}
+        for msg in ChatMessage.query.filter(
+            ChatMessage.game_id == None,
+            ChatMessage.ticket_id == None,
+            ChatMessage.admin_message == False,
+            ChatMessage.sender_id != None,
+            ChatMessage.receiver_id != None,
+        ).order_by(ChatMessage.id).yield_per(1000):
+            for player_id, other_id in ((msg.sender_id, msg.receiver_id),
+                                        (msg.receiver_id, msg.sender_id)):
+                key = player_id, other_id
+                if key not in convs:
+                    convs[key] = cls(player_id=player_id, other_id=other_id,
+                                     unread=0)
+                convs[key].set_last(msg)
+            if not msg.viewed:
+                convs[msg.receiver_id, msg.sender_id].unread += 1
+        db.session.add_all(convs.values())
+        db.session.commit()
+        return len(convs)
+
+    def __repr__(self):
+        return '<Conversation player_id={} other_id={}>'.format(
+            self.player_id, self.other_id)
+
+
 class Event(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     # game should be the root game of inner challenges hierarchy
@@ -1065,6 +1851,11 @@ class Event(db.Model):
     # for 'betstate' type
     newstate = db.Column(db.String(128))
 
+    __table_args__ = (
+        # for session timeline
+        db.Index('ix_event_timeline', 'root_id', 'time', 'id'),
+    )
+
 
 class Beta(db.Model):
     id = db.Column(db.Integer, primary_key=True)
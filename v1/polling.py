@@ -10,6 +10,8 @@ from urllib.parse import quote
 
 import requests
 from dateutil.parser import parse as date_parse
+from eventlet import GreenPool
+from flask import current_app
 
 if __name__ == '__main__':
     # debugging environment; other changes are in the bottom
@@ -55,7 +57,7 @@ class Identity(namedtuple('Identity', 'id name checker choices formatter')):
 Identity('riot_summonerName', 'Riot Summoner Name ("name" or "region/name")',
             Riot.summoner_check)
 Identity('steam_id','STEAM ID (numeric, URL or nickname)', Steam.pretty_id,
-         formatter = lambda x: Steam.split_identity(x)[1])
+         formatter = Steam.split_identity)
 Identity('starcraft_uid','StarCraft profile URL from battle.net or sc2ranks.com',
             StarCraft.check_uid)
 # ea_gamertag, fifa_team, tibia_character - will be added in classes
@@ -215,6 +217,7 @@ class Poller:
         Returns True for convenience (`return self.gameDone(...)`).
         """
         log.debug('Marking game {} as done'.format(game))
+        old_state = game.state
         if winner == 'aborted':
             game.winner = 'draw'
             game.state = 'aborted'
@@ -228,9 +231,16 @@ class Poller:
             game.finish_date = timestamp
         else:
             game.finish_date = datetime.utcfromtimestamp(timestamp)
+        PlayerStats.game_state_changed(game, old_state)
         db.session.commit() # to avoid observer overwriting it before us..
 
         # move funds (only if somebody won)
+        # and unlock bets (always), withdrawing them finally from accounts.
+        # Other partitions and API can change the same players meanwhile,
+        # so change them in SQL instead of read-modify-write;
+        # rows stay locked till commit. Lock order by id avoids deadlocks.
+        deltas = {game.creator_id: 0, game.opponent_id: 0}
+        looser = None
         if winner in ['creator', 'opponent']:
             if winner == 'creator':
                 winner = game.creator
@@ -238,8 +248,16 @@ class Poller:
             elif winner == 'opponent':
                 winner = game.opponent
                 looser = game.creator
-            winner.balance += game.bet
-            looser.balance -= game.bet
+            deltas[winner.id] += game.bet
+            deltas[looser.id] -= game.bet
+        for player_id in sorted(deltas):
+            Player.query.filter_by(id=player_id).update({
+                Player.balance: Player.balance + deltas[player_id],
+                Player.locked: Player.locked - game.bet,
+            }, synchronize_session=False)
+        for player in game.creator, game.opponent:
+            db.session.refresh(player, ['balance', 'locked'])
+        if looser:
             db.session.add(Transaction(
                 player = winner,
                 type = 'won',
@@ -254,13 +272,12 @@ class Poller:
                 balance = looser.balance,
                 game = game,
             ))
-        # and unlock bets (always)
-        # withdrawing them finally from accounts
-        game.creator.locked -= game.bet
-        game.opponent.locked -= game.bet
 
         db.session.commit()
 
+        for player in game.creator, game.opponent:
+            player.reset_winratehist()
+
         notify_users(game)
 
         # cancel stream watcher (if any)
@@ -1012,6 +1029,63 @@ for poller in Poller.allPollers():
     if poller.twitch_identity_id and not poller.twitch_identity:
         raise ValueError('Bad twitch identity id: '+poller.identity_id)
 
+
+class GametypeDescriptor(namedtuple('GametypeDescriptor', [
+    'poller',
+    'identity_id', 'identity_name', 'formatter',
+    'twitch_identity_id', 'twitch_identity_name',
+    'gamemodes_ingame',
+])):
+    """
+    Everything Game properties need to know about gametype,
+    resolved once on import so that they don't look up poller every time.
+    """
+    @classmethod
+    def build(cls, poller):
+        identity = poller.identity
+        twitch_identity = poller.twitch_identity
+        return cls(
+            poller=poller,
+            identity_id=identity.id if identity else None,
+            identity_name=identity.name if identity else None,
+            # the same gamertags are formatted again and again
+            formatter=lru_cache(maxsize=1024)(
+                identity.formatter if identity
+                else lambda val: (val, str(val))),
+            twitch_identity_id=twitch_identity.id if twitch_identity else None,
+            twitch_identity_name=twitch_identity.name
+            if twitch_identity else None,
+            gamemodes_ingame=frozenset(poller.gamemodes_ingame),
+        )
+
+gametype_descriptors = {}
+for poller in Poller.allPollers():
+    descriptor = GametypeDescriptor.build(poller)
+    for gametype in poller.gametypes:
+        # first poller wins, like in findPoller
+        gametype_descriptors.setdefault(gametype, descriptor)
+if __name__ != '__main__':
+    Game.register_gametypes(gametype_descriptors)
+
+def poll_partition(flask_app, poller, now, gametype, gamemode=None):
+    """
+    Poll games of one gametype (and gamemode, if poller uses them)
+    with its own poller instance and its own DB session.
+    Is run in a separate green thread.
+    """
+    with flask_app.app_context():
+        # app context is greenthread-local, and so is db session
+        try:
+            pin = poller()
+            pin.prepare()
+            pin.poll(now, gametype, gamemode)
+        except Exception:
+            log.exception('Polling failed for {} {}'.format(gametype, gamemode))
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+
 def poll_all():
     log.info('Polling started')
 
@@ -1020,19 +1094,25 @@ def poll_all():
         datetime.utcnow().timestamp() // (5*60) * (5*60)
     )
 
-    # TODO: run them all simultaneously in background, to use 2sec api delays
+    # Run all pollers (and gametypes/gamemodes within them) simultaneously,
+    # so that one API's delays don't hold the others.
+    # LimitedApi rate-limits requests to each API by itself.
+    pool = GreenPool(config.POLL_CONCURRENCY)
+    flask_app = current_app._get_current_object()
     for poller in Poller.allPollers():
         if not poller.identity: # root or dummy
             continue
         if poller.minutes and now.minute % poller.minutes != 0:
             log.info('Skipping poller {} because of timeframes'.format(poller))
             continue
-        pin = poller()
-        pin.poll(now)
+        for gametype in poller.gametypes:
+            for gamemode in poller.gamemodes if poller.usemodes else [None]:
+                pool.spawn_n(poll_partition, flask_app,
+                             poller, now, gametype, gamemode)
+    pool.waitall()
 
     log.info('Polling done')
 
-
 if __name__ == '__main__':
     notify_users = dummyfunc(
         '** Notifying users about state change in game {}')
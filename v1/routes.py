@@ -1,10 +1,10 @@
 from flask import request, jsonify, current_app, g, send_file, make_response, redirect
-from flask import copy_current_request_context
 from flask.ext import restful
 from flask.ext.restful import fields, marshal
-from flask.ext.socketio import send as sio_send, disconnect as sio_disconnect
+from flask.ext.socketio import disconnect as sio_disconnect
 from sqlalchemy.sql.expression import func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, subqueryload
 
 from werkzeug.exceptions import HTTPException
 from werkzeug.exceptions import MethodNotAllowed, Forbidden, NotFound
@@ -15,7 +15,9 @@ from io import BytesIO
 from datetime import datetime, timedelta
 import math
 import json
+import time
 import operator
+from functools import lru_cache
 import requests
 from PIL import Image
 import eventlet
@@ -28,6 +30,7 @@ from .helpers import * # noqa
 from .apis import * # noqa
 from .polling import * # noqa
 from .helpers import MyRequestParser as RequestParser  # instead of system one
+from .serializers import Serializer
 from .main import app, db, api, socketio, redis
 
 
@@ -115,6 +118,11 @@ class PlayerResource(restful.Resource):
         ))
         return ret
 
+    @classmethod
+    @lru_cache()
+    def serializer(cls, public=True, stat=False, leaders=False):
+        return Serializer(cls.fields(public, stat, leaders))
+
     @classmethod
     def login_do(cls, player, args=None, created=False):
         if not args:
@@ -188,42 +196,56 @@ class PlayerResource(restful.Resource):
                 query = Player.query
 
             orders = []
+            tiebreak = Player.id
             if args.order:
                 ordername = args.order.lstrip('-')
-                if hasattr(Player, ordername + '_impl'):
-                    # this parameter depends on games,
-                    # so calculate and apply corresponding filters
-                    filters = []
+                if ordername in PlayerStats.ORDERS and not args.period:
+                    # use materialized statistics, it is a plain index read
+                    stats_gametype = PlayerStats.ALL
+                    if ordername != 'lastbet':
+                        g.winrate_filt = []
+                        if args.gametype:
+                            stats_gametype = args.gametype
+                            g.winrate_filt.append(
+                                Game.gametype == args.gametype)
+                    query = query.join(
+                        PlayerStats,
+                        PlayerStats.player_id == Player.id,
+                    ).filter(PlayerStats.gametype == stats_gametype)
+                    orders.append(getattr(PlayerStats,
+                                          PlayerStats.ORDERS[ordername]))
+                    if ordername == 'winrate':
+                        # sort also by game count
+                        orders.append(PlayerStats.games)
+                    tiebreak = PlayerStats.player_id
+                elif ordername in PlayerDailyStats.ORDERS:
+                    # period leaderboard: sum up daily buckets
+                    totals = PlayerDailyStats.period_totals(
+                        args.period, args.gametype or PlayerDailyStats.ALL)
+                    query = query.join(
+                        totals,
+                        totals.c.player_id == Player.id,
+                    )
+                    orders.append(
+                        totals.c[PlayerDailyStats.ORDERS[ordername]])
+                    if ordername == 'winrate':
+                        # sort also by game count
+                        orders.append(totals.c.games)
+                    # and output values for the same period
+                    since, till = PlayerDailyStats.period_range(args.period)
+                    g.winrate_filt = [
+                        Game.accept_date >= datetime.combine(
+                            since, datetime.min.time()),
+                        Game.accept_date < datetime.combine(
+                            till + timedelta(days=1), datetime.min.time()),
+                    ]
                     if args.gametype:
-                        filters.append(Game.gametype == args.gametype)
-                    if args.period:
-                        till = None
-                        if args.period == 'today':
-                            since = timedelta(days=1)
-                        elif args.period == 'yesterday':
-                            since = timedelta(days=2)
-                            till = timedelta(days=1)
-                        elif args.period == 'week':
-                            since = timedelta(weeks=1)
-                        elif args.period == 'month':
-                            since = timedelta(days=30)
-                        else:
-                            raise ValueError('unknown period ' + args.period)
-                        now = datetime.utcnow()
-                        filters.append(Game.accept_date >= now - since)
-                        if till:
-                            filters.append(Game.accept_date < now - till)
-                    orders.append(getattr(Player, ordername + '_impl')(*filters))
-                    g.winrate_filt = filters
+                        g.winrate_filt.append(Game.gametype == args.gametype)
                 else:
                     orders.append(getattr(Player, ordername))
-                # special handling for order by winrate:
-                if args.order.endswith('winrate'):
-                    # sort also by game count
-                    orders.append(Player.gamecount)
-                    # ...and always add player.id to stabilize order
+            # ...and always add player.id to stabilize order
             if not args.order or not args.order.endswith('id'):
-                orders.append(Player.id)
+                orders.append(tiebreak)
             if args.order:
                 orders = map(
                     operator.methodcaller(
@@ -235,12 +257,10 @@ class PlayerResource(restful.Resource):
             query = query.limit(20)
 
             return jsonify(
-                players=fields.List(
-                    fields.Nested(
-                        self.fields(public=True, stat=True,
-                                    leaders='winrate' in (args.order or ''))
-                    )
-                ).format(query),
+                players=self.serializer(
+                    public=True, stat=True,
+                    leaders='winrate' in (args.order or ''),
+                ).many(query),
             )
 
         parser = RequestParser()
@@ -340,6 +360,12 @@ class PlayerResource(restful.Resource):
 
         db.session.commit()
 
+        if args.password:
+            # tokens issued for old password are no longer valid
+            forgetTokens(user)
+        if any(args.get(identity) for identity in Player._identities):
+            Player.forget_find(user)
+
         return marshal(user, self.fields(public=False))
 
     @app.route('/players/<id>/login', methods=['POST'])
@@ -354,6 +380,9 @@ class PlayerResource(restful.Resource):
 
         if not check_password(args.password, player.password):
             abort('Incorrect login or password', 403)
+        if password_needs_rehash(player.password):
+            # will be committed by login_do
+            player.password = rehash_password(args.password, player.password)
 
         datadog('Player regular login', 'nickname: {}'.format(player.nickname))
         dd_stat.increment('user.login')
@@ -573,6 +602,8 @@ class PlayerResource(restful.Resource):
         # TODO: delete device itself?
         db.session.commit()
 
+        forgetToken(g.token)
+
         return jsonify(success=True)
 
     @app.route('/players/<id>/recent_opponents')
@@ -581,9 +612,8 @@ class PlayerResource(restful.Resource):
         if Player.find(id) != user:
             raise Forbidden
 
-        return jsonify(opponents=fields.List(fields.Nested(
-            PlayerResource.fields(public=True)
-        )).format(user.recent_opponents))
+        return jsonify(opponents=PlayerResource.serializer(
+            public=True).many(user.recent_opponents))
 
     @app.route('/players/<id>/winratehist')
     @require_auth
@@ -636,11 +666,7 @@ class FriendsResource(restful.Resource):
         players = Player.query.filter(Player.nickname.like('test_player_%'))
 
         return dict(
-            players=fields.List(
-                fields.Nested(
-                    PlayerResource.fields(public=True)
-                )
-            ).format(players),
+            players=PlayerResource.serializer(public=True).many(players),
         )
 
 
@@ -650,6 +676,10 @@ class UploadableResource(restful.Resource):
     ROOT = os.path.dirname(__file__) + '/../uploads'
     SUBDIR = None
     ALLOWED = None
+    # If set, stored file extension and version are tracked
+    # in entity's `<COLUMN>_ext` and `<COLUMN>_version` fields,
+    # so that we don't need to probe filesystem.
+    COLUMN = None
 
     @classmethod
     def url_for(cls, entity, ext):
@@ -674,13 +704,24 @@ class UploadableResource(restful.Resource):
                 return f
         return None
 
+    @classmethod
+    def stored_ext(cls, entity):
+        if cls.COLUMN:
+            return getattr(entity, cls.COLUMN + '_ext')
+        f = cls.findfile(entity)
+        return f.rsplit('.', 1)[-1] if f else None
+
     @classmethod
     def onupload(cls, entity, ext):
-        pass
+        if cls.COLUMN:
+            setattr(entity, cls.COLUMN + '_ext', ext)
+            version = getattr(entity, cls.COLUMN + '_version') or 0
+            setattr(entity, cls.COLUMN + '_version', version + 1)
 
     @classmethod
     def ondelete(cls, entity):
-        pass
+        if cls.COLUMN:
+            setattr(entity, cls.COLUMN + '_ext', None)
 
     @classmethod
     def found(cls, entity, ext):
@@ -702,6 +743,13 @@ class UploadableResource(restful.Resource):
                 cls.ondelete(entity)
         return deleted
 
+    @classmethod
+    def ensure_id(cls, entity):
+        # file name is based on id, so new entity should be flushed first
+        if entity.id is None:
+            db.session.add(entity)
+            db.session.flush()
+
     @classmethod
     def upload(cls, f, entity):
         ext = f.filename.lower().rsplit('.', 1)[-1]
@@ -711,6 +759,7 @@ class UploadableResource(restful.Resource):
 
         # FIXME: limit size
 
+        cls.ensure_id(entity)
         cls.delfile(entity)
 
         f.save(cls.file_for(entity, ext))
@@ -725,6 +774,7 @@ class UploadableResource(restful.Resource):
         if len(cls.ALLOWED) > 1:
             raise ValueError('This is only applicable for single-ext resources')
 
+        cls.ensure_id(entity)
         cls.delfile(entity)
         ret = requests.get(url, stream=True)
         with open(cls.file_for(entity, cls.ALLOWED[0]), 'wb') as f:
@@ -741,17 +791,19 @@ class UploadableResource(restful.Resource):
 
     def get(self, **kwargs):
         entity = self.get_entity(kwargs, False)
-        for ext in self.ALLOWED:
-            f = self.file_for(entity, ext)
-            if os.path.exists(f):
-                self.found(entity, ext)
-                response = make_response()
-                response.headers['X-Accel-Redirect'] = self.url_for(entity, ext)
-                response.headers['Content-Type'] = ''  # autodetect by nginx
-                return response
-        else:
+        ext = self.stored_ext(entity)
+        if not ext:
             self.notfound(entity)
             return (None, 204)  # HTTP code 204 NO CONTENT
+        self.found(entity, ext)
+        response = make_response()
+        response.headers['X-Accel-Redirect'] = self.url_for(entity, ext)
+        response.headers['Content-Type'] = ''  # autodetect by nginx
+        if self.COLUMN:
+            response.set_etag('{}.{}'.format(
+                getattr(entity, self.COLUMN + '_version'), ext))
+            response = response.make_conditional(request)
+        return response
 
     def put(self, **kwargs):
         entity = self.get_entity(kwargs, True)
@@ -760,6 +812,7 @@ class UploadableResource(restful.Resource):
             abort('[{}]: please provide file!'.format(self.PARAM))
 
         self.upload(f, entity)
+        db.session.commit()
 
         return dict(success=True)
 
@@ -767,8 +820,10 @@ class UploadableResource(restful.Resource):
         return self.put(*args, **kwargs)
 
     def delete(self, **kwargs):
+        deleted = self.delfile(self.get_entity(kwargs, True))
+        db.session.commit()
         return dict(
-            deleted=self.delfile(self.get_entity(kwargs, True)),
+            deleted=deleted,
         )
 
 
@@ -777,6 +832,7 @@ class UserpicResource(UploadableResource):
     PARAM = 'userpic'
     SUBDIR = 'userpics'
     ALLOWED = ['png']
+    COLUMN = 'userpic'
 
     @require_auth
     def get_entity(self, args, is_put, user):
@@ -797,32 +853,48 @@ def balance_get(user):
     )
 
 
+transaction_serializer = Serializer(dict(
+    id=fields.Integer,
+    date=fields.DateTime,
+    type=fields.String,
+    sum=fields.Float,
+    balance=fields.Float,
+    game_id=fields.Integer,
+    comment=fields.String,
+))
+
+
 @app.route('/balance/history', methods=['GET'])
 @require_auth
 def balance_history(user):
     parser = RequestParser()
     parser.add_argument('page', type=int, default=1)
     parser.add_argument('results_per_page', type=int, default=10)
+    parser.add_argument('after')
+    parser.add_argument('with_count', type=boolean_field, default=False)
     args = parser.parse_args()
 
     if args.results_per_page > 50:
         abort('[results_per_page]: max is 50')
 
     query = user.transactions
+    if args.after is not None:
+        items, cursor = keyset_paginate(query, Transaction, 'id',
+                                        args.after, args.results_per_page)
+        ret = dict(
+            transactions=transaction_serializer.many(items),
+            next=cursor,
+        )
+        if args.with_count:
+            ret['num_results'] = query.count()
+        return jsonify(**ret)
+
     total_count = query.count()
     query = query.paginate(args.page, args.results_per_page,
                            error_out=False).items
 
     return jsonify(
-        transactions=fields.List(fields.Nested(dict(
-            id=fields.Integer,
-            date=fields.DateTime,
-            type=fields.String,
-            sum=fields.Float,
-            balance=fields.Float,
-            game_id=fields.Integer,
-            comment=fields.String,
-        ))).format(query),
+        transactions=transaction_serializer.many(query),
         num_results=total_count,
         total_pages=math.ceil(total_count / args.results_per_page),
         page=args.page,
@@ -1231,7 +1303,7 @@ class GameResource(restful.Resource):
             'parent_id': fields.Integer,
             'is_root': fields.Boolean,
             'gamertag_creator': fields.String(attribute='gamertag_creator_text'),
-            'gamertag_opponent': fields.String(attribute='gamertag_creator_text'),
+            'gamertag_opponent': fields.String(attribute='gamertag_opponent_text'),
             'identity_id': fields.String,
             'identity_name': fields.String,
             'twitch_handle': fields.String,
@@ -1263,6 +1335,36 @@ class GameResource(restful.Resource):
         })
         return ret
 
+    @classproperty
+    def load_plan(cls):
+        """
+        Relationships used by `fields`,
+        so that a page of games is loaded with fixed number of queries.
+        """
+        return [
+            joinedload(Game.creator),
+            joinedload(Game.opponent),
+            joinedload(Game.aborter),
+            subqueryload(Game.children).joinedload(Game.creator),
+            subqueryload(Game.children).joinedload(Game.opponent),
+            subqueryload(Game.children).joinedload(Game.aborter),
+        ]
+
+    @staticmethod
+    def ordered(query, order=None):
+        """
+        Applies `order` argument, with id as the last key.
+        Offset pagination needs deterministic order:
+        otherwise pages can overlap, and children subquery,
+        which re-runs the limited query, can get other games than the page.
+        """
+        if not order:
+            return query.order_by(Game.id)
+        if order.startswith('-'):
+            return query.order_by(getattr(Game, order[1:]).desc(),
+                                  Game.id.desc())
+        return query.order_by(getattr(Game, order).asc(), Game.id)
+
     @require_auth
     def get(self, user, id=None):
         if id:
@@ -1290,6 +1392,8 @@ class GameResource(restful.Resource):
                   )], []),
             required=False,
         )
+        parser.add_argument('after')
+        parser.add_argument('with_count', type=boolean_field, default=False)
         args = parser.parse_args()
         # cap
         if args.results_per_page > 50:
@@ -1298,19 +1402,26 @@ class GameResource(restful.Resource):
         query = user.games
 
         # TODO: filters
-        if args.order:
-            if args.order.startswith('-'):
-                order = getattr(Game, args.order[1:]).desc()
-            else:
-                order = getattr(Game, args.order).asc()
-            query = query.order_by(order)
+        if args.after is not None:
+            items, cursor = keyset_paginate(query.options(*self.load_plan),
+                                            Game, args.order or 'id',
+                                            args.after, args.results_per_page)
+            ret = dict(
+                games=self.serializer.many(items),
+                next=cursor,
+            )
+            if args.with_count:
+                ret['num_results'] = query.count()
+            return ret
+
+        query = self.ordered(query, args.order)
 
         total_count = query.count()
-        query = query.paginate(args.page, args.results_per_page,
-                               error_out=False)
+        query = query.options(*self.load_plan).paginate(
+            args.page, args.results_per_page, error_out=False)
 
         return dict(
-            games=fields.List(fields.Nested(self.fields)).format(query.items),
+            games=self.serializer.many(query.items),
             num_results=total_count,
             total_pages=math.ceil(total_count / args.results_per_page),
             page=args.page,
@@ -1532,6 +1643,7 @@ class GameResource(restful.Resource):
             game.bet = args.bet
 
         db.session.add(game)
+        PlayerStats.game_created(game)
         db.session.commit()
 
         log.debug('notifying')
@@ -1646,8 +1758,10 @@ class GameResource(restful.Resource):
                           'please retry later', 500)
                 abort('Couldn\'t start Twitch: ' + jret.get('error', 'Unknown err'))
 
+        old_state = game.state
         game.state = args.state
         game.accept_date = datetime.utcnow()
+        PlayerStats.game_state_changed(game, old_state)
 
         if args.state == 'accepted':
             # bet is locked on creator's account; lock it on opponent's as well
@@ -1690,6 +1804,10 @@ class GameResource(restful.Resource):
             aborted=True,
         )
 
+# compiled once here, as fields refer to other resources
+GameResource.serializer = Serializer(GameResource.fields)
+
+
 
 @api.resource('/games/<int:game_id>/report')
 class GameReportResource(restful.Resource):
@@ -1840,6 +1958,7 @@ class GameMessageResource(UploadableResource):
     PARAM = 'msg'
     SUBDIR = 'messages'
     ALLOWED = ['mpg', 'mp3', 'ogg', 'ogv', 'mp4', 'm4a']
+    COLUMN = 'message'
 
     @require_auth
     def get_entity(self, args, is_put, user):
@@ -1880,6 +1999,11 @@ class ChatMessageResource(restful.Resource):
             viewed=fields.Boolean,
         )
 
+    load_plan = [
+        joinedload(ChatMessage.sender),
+        joinedload(ChatMessage.receiver),
+    ]
+
     def get_single(self, user, game_id=None, player_id=None, ticket_id=None, id=None):
         msg = ChatMessage.query.get_or_404(id)
         if not msg.is_for(user):
@@ -1943,12 +2067,26 @@ class ChatMessageResource(restful.Resource):
                     'time',
                 )], []),
         )
+        parser.add_argument('after')
+        parser.add_argument('with_count', type=boolean_field, default=False)
         args = parser.parse_args()
         if args.results_per_page > 50:
             abort('[results_per_page]: max is 50')
 
         # TODO: filtering
 
+        if args.after is not None:
+            items, cursor = keyset_paginate(messages.options(*self.load_plan),
+                                            ChatMessage, args.order,
+                                            args.after, args.results_per_page)
+            ret = dict(
+                messages=self.serializer.many(items),
+                next=cursor,
+            )
+            if args.with_count:
+                ret['num_results'] = messages.count()
+            return ret
+
         if args.order.startswith('-'):
             order = getattr(ChatMessage, args.order[1:]).desc()
         else:
@@ -1956,13 +2094,10 @@ class ChatMessageResource(restful.Resource):
         messages = messages.order_by(order)
 
         total_count = messages.count()
-        messages = messages.paginate(args.page, args.results_per_page,
-                                     error_out=False).items
+        messages = messages.options(*self.load_plan).paginate(
+            args.page, args.results_per_page, error_out=False).items
 
-        ret = marshal(
-            dict(messages=messages),
-            dict(messages=fields.List(fields.Nested(self.fields))),
-        )
+        ret = dict(messages=self.serializer.many(messages))
         ret.update(dict(
             num_results=total_count,
             total_pages=math.ceil(total_count / args.results_per_page),
@@ -2016,6 +2151,7 @@ class ChatMessageResource(restful.Resource):
             db.session.expunge(msg)
             abort('Please provide either text or attachment, or both')
 
+        Conversation.message_posted(msg)
         db.session.commit()
 
         notify_chat(msg)
@@ -2036,10 +2172,48 @@ class ChatMessageResource(restful.Resource):
         # we allow marking message as unread
         args = parser.parse_args()
 
+        was_viewed = msg.viewed
         msg.viewed = args.viewed
+        Conversation.message_viewed(msg, was_viewed)
         db.session.commit()
         return marshal(msg, self.fields)
 
+ChatMessageResource.serializer = Serializer(ChatMessageResource.fields)
+
+
+
+@app.route('/players/<id>/conversations')
+@require_auth
+def conversations(user, id):
+    if Player.find(id) != user:
+        raise Forbidden
+
+    parser = RequestParser()
+    parser.add_argument('results_per_page', type=int, default=20)
+    parser.add_argument('after', default='')
+    args = parser.parse_args()
+    if args.results_per_page > 50:
+        abort('[results_per_page]: max is 50')
+
+    query = Conversation.query.filter_by(
+        player_id=user.id,
+    ).options(joinedload(Conversation.other))
+    items, cursor = keyset_paginate(query, Conversation, '-last_time',
+                                    args.after, args.results_per_page)
+    return jsonify(
+        conversations=conversation_serializer.many(items),
+        next=cursor,
+    )
+
+
+conversation_serializer = Serializer(dict(
+    other=fields.Nested(PlayerResource.fields(public=True)),
+    last_message_id=fields.Integer,
+    last_time=fields.DateTime,
+    preview=fields.String,
+    unread=fields.Integer,
+))
+
 
 @api.resource(
     '/players/<player_id>/messages/<int:id>/attachment',
@@ -2124,6 +2298,16 @@ class EventResource(restful.Resource):
         ret['root'] = fields.Nested(GameResource.fields)
         return ret
 
+    @classproperty
+    def load_plan(cls):
+        return [
+            joinedload(Event.message).joinedload(ChatMessage.sender),
+            joinedload(Event.message).joinedload(ChatMessage.receiver),
+            joinedload(Event.game).joinedload(Game.creator),
+            joinedload(Event.game).joinedload(Game.opponent),
+            joinedload(Event.game).joinedload(Game.aborter),
+        ]
+
     @require_auth
     def get(self, user, game_id, id=None):
         root = Game.query.get_or_404(game_id)
@@ -2132,17 +2316,38 @@ class EventResource(restful.Resource):
         if id:
             event = Event.query.filter_by(root=root, id=id).first_or_404()
             return marshal(event, self.fields)
-        # TODO custom filters, pagination
-        events = Event.query.filter(
+        parser = RequestParser()
+        parser.add_argument('results_per_page', type=int, default=50)
+        parser.add_argument('after')
+        parser.add_argument('since_id', type=int)
+        args = parser.parse_args()
+        if args.results_per_page > 100:
+            abort('[results_per_page]: max is 100')
+
+        # TODO custom filters
+        events = Event.query.options(*self.load_plan).filter(
             Event.root_id == root.id,
-        ).order_by(
-            Event.time,
         )
-        return marshal(
-            dict(events=events),
-            dict(events=fields.List(fields.Nested(self.fields))),
+        if args.since_id is not None:
+            # incremental mode: only events newer than given one
+            since = Event.query.filter_by(root=root, id=args.since_id).first()
+            if not since:
+                abort('[since_id]: unknown event', 404, problem='since_id')
+            args.after = make_cursor('time', since)
+        if args.after is None:
+            # legacy mode: whole timeline at once
+            return dict(events=self.serializer.many(
+                events.order_by(Event.time, Event.id)))
+        items, cursor = keyset_paginate(events, Event, 'time',
+                                        args.after, args.results_per_page)
+        return dict(
+            events=self.serializer.many(items),
+            next=cursor,
         )
 
+EventResource.serializer = Serializer(EventResource.fields)
+
+
 
 # Beta testers
 @api.resource(
@@ -2172,9 +2377,7 @@ class BetaResource(restful.Resource):
             raise Forbidden
 
         return jsonify(
-            betatesters=fields.List(fields.Nested(self.fields)).format(
-                Beta.query,
-            ),
+            betatesters=self.serializer.many(Beta.query),
         )
 
     def post(self, id=None):
@@ -2260,12 +2463,90 @@ class BetaResource(restful.Resource):
 
         return marshal(beta, self.fields)
 
+BetaResource.serializer = Serializer(BetaResource.fields)
+
+
 @socketio.on('connect')
 def socketio_conn():
     log.info('socket connected')
     # TODO check auth...
     #return False # if auth failed
-_sockets = {} # sid -> sender
+class SocketDispatcher:
+    """
+    Delivers events published to Redis to authorized sockets.
+    There is one pattern subscription per worker process,
+    read by a single greenlet which sends each event
+    to all sockets of corresponding player.
+    """
+    def __init__(self):
+        self.pattern = '{}.event.*'.format('test' if config.TEST else 'prod')
+        self.prefix = self.pattern[:-1]
+        self.players = {} # sid -> player id
+        self.sids = {} # player id -> set of sids
+        self.listener = None
+
+    def __contains__(self, sid):
+        return sid in self.players
+
+    def add(self, sid, player_id):
+        self.players[sid] = player_id
+        self.sids.setdefault(player_id, set()).add(sid)
+        dd_stat.gauge('socket.connected', len(self.players))
+        if not self.listener:
+            self.listener = eventlet.spawn(
+                self.listen, current_app._get_current_object())
+
+    def remove(self, sid):
+        player_id = self.players.pop(sid, None)
+        if player_id is None:
+            return False
+        sids = self.sids.get(player_id)
+        sids.discard(sid)
+        if not sids:
+            del self.sids[player_id]
+        dd_stat.gauge('socket.connected', len(self.players))
+        return True
+
+    def listen(self, flask_app):
+        with flask_app.app_context():
+            while True:
+                try:
+                    p = redis.pubsub(ignore_subscribe_messages=True)
+                    p.psubscribe(self.pattern)
+                    for msg in p.listen(): # blocks until next message
+                        self.dispatch(msg)
+                except Exception:
+                    log.exception('Socket dispatcher failure, will resubscribe')
+                    eventlet.sleep(1)
+
+    def dispatch(self, msg):
+        if msg.get('type') != 'pmessage':
+            return
+        channel = msg['channel']
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        try:
+            player_id = int(channel[len(self.prefix):])
+        except ValueError:
+            log.warning('Bad event channel: '+channel)
+            return
+        sids = self.sids.get(player_id)
+        if not sids:
+            return # this player has no sockets on this worker
+
+        mdata = msg.get('data')
+        try:
+            if isinstance(mdata, bytes):
+                mdata = mdata.decode()
+            data = json.loads(mdata)
+        except ValueError:
+            log.warning('Bad msg, not a json: '+str(mdata))
+            return
+        started = time.time()
+        for sid in list(sids):
+            socketio.send(data, room=sid, namespace='/')
+        dd_stat.histogram('socket.fanout_time', time.time() - started)
+_sockets = SocketDispatcher()
 @socketio.on('auth')
 def socketio_auth(token=None):
     log.info('Auth request for socket {}, token {}'.format(
@@ -2282,40 +2563,12 @@ def socketio_auth(token=None):
         return
 
     log.info('Socket auth success for {}'.format(request.sid))
-    @copy_current_request_context
-    def sender():
-        p = redis.pubsub()
-        redis_base = '{}.event.%s'.format('test' if config.TEST else 'prod')
-        p.subscribe(redis_base % user.id)
-        try:
-            while True:
-                msg = p.get_message()
-                if not msg:
-                    eventlet.sleep(.5)
-                    continue
-
-                log.debug('got msg: %s'%msg)
-                if 'message' not in msg.get('type', ''): # msg or pmsg
-                    continue
-                mdata = msg.get('data')
-                try:
-                    if isinstance(mdata, bytes):
-                        mdata = mdata.decode()
-                    data = json.loads(mdata)
-                except ValueError:
-                    log.warning('Bad msg, not a json: '+str(mdata))
-                    continue
-                log.debug('handling msg')
-                sio_send(data)
-        finally:
-            p.unsubscribe()
-    _sockets[request.sid] = eventlet.spawn(sender)
+    _sockets.add(request.sid, user.id)
 @socketio.on('disconnect')
 def socketio_disconn():
-    sender = _sockets.pop(request.sid, None)
-    log.debug('socket disconnected, will kill? - {} {}'.format(sender, request.sid))
-    if sender:
-        sender.kill()
+    removed = _sockets.remove(request.sid)
+    log.debug('socket disconnected, was authorized? - {} {}'.format(
+        removed, request.sid))
 
 
 
@@ -2360,6 +2613,7 @@ class TournamentResource(restful.Resource):
         'gamemode': fields.String,
         'gametype': fields.String,
     }
+    serializer_many = Serializer(fields_many)
 
     @require_auth
     def post(self, user, id=None):
@@ -2440,6 +2694,8 @@ class TournamentResource(restful.Resource):
             )
             ], [])
         )
+        parser.add_argument('after')
+        parser.add_argument('with_count', type=boolean_field, default=False)
         args = parser.parse_args()
         # cap
         if args.results_per_page > 50:
@@ -2448,6 +2704,17 @@ class TournamentResource(restful.Resource):
         query = Tournament.query.filter(Tournament.available == True)
 
         # TODO: filters
+        if args.after is not None:
+            items, cursor = keyset_paginate(query, Tournament, args.order,
+                                            args.after, args.results_per_page)
+            ret = dict(
+                tournaments=self.serializer_many.many(items),
+                next=cursor,
+            )
+            if args.with_count:
+                ret['num_results'] = query.count()
+            return ret
+
         if args.order:
             if args.order.startswith('-'):
                 order = getattr(Tournament, args.order[1:]).desc()
@@ -2459,7 +2726,7 @@ class TournamentResource(restful.Resource):
         query = query.paginate(args.page, args.results_per_page,
                                error_out=False)
         return dict(
-            tournaments=fields.List(fields.Nested(self.fields_many)).format(query.items),
+            tournaments=self.serializer_many.many(query.items),
             num_results=total_count,
             total_pages=math.ceil(total_count / args.results_per_page),
             page=args.page,
@@ -2545,6 +2812,15 @@ def debug_datadog():
     return ''
 
 
+@app.route('/debug/stats')
+@require_auth
+def debug_stats(user):
+    if user.id not in config.ADMIN_IDS:
+        raise Forbidden
+    from .metrics import summary
+    return jsonify(endpoints=summary())
+
+
 @app.route('/debug/money')
 @require_auth
 def debug_money(user):
@@ -0,0 +1,156 @@
+"""
+Precompiled serializers.
+
+They produce the same output as flask-restful's `marshal` for the same fields
+dict, but the dict is analyzed only once: attribute getters and formatters
+are resolved up front, and nested field sets are compiled recursively.
+Field types we don't know about fall back to their own `output` method.
+"""
+from collections import OrderedDict
+from functools import lru_cache
+
+from flask.ext.restful import fields
+
+
+def _make(field):
+    return field() if isinstance(field, type) else field
+
+
+def _getter(key):
+    """
+    Same lookup as `flask_restful.fields.get_value`.
+    """
+    if callable(key):
+        return key
+
+    def get_one(key, obj):
+        if hasattr(obj, '__getitem__'):
+            try:
+                return obj[key]
+            except (IndexError, TypeError, KeyError):
+                pass
+        return getattr(obj, key, None)
+
+    if not isinstance(key, str) or '.' not in key:
+        return lambda obj: get_one(key, obj)
+
+    keys = key.split('.')
+
+    def get_chain(obj):
+        for k in keys:
+            obj = get_one(k, obj)
+            if obj is None:
+                return None
+        return obj
+    return get_chain
+
+
+# exact field types whose `format` is a plain conversion
+_CONVERTERS = {
+    fields.Raw: None,
+    fields.String: str,
+    fields.Integer: int,
+    fields.Float: float,
+    fields.Boolean: bool,
+}
+
+
+def _nested(field):
+    """
+    Compile output function for a Nested field applied to already got value.
+    """
+    serialize = compile_fields(field.nested)
+    allow_null = field.allow_null
+    default = field.default
+
+    def output(value):
+        if value is None:
+            if allow_null:
+                return None
+            if default is not None:
+                return default
+        return serialize(value)
+    return output
+
+
+def _is_list(value):
+    return hasattr(value, '__iter__') and not isinstance(value, (str, dict))
+
+
+def _compile_field(key, field):
+    field = _make(field)
+    if isinstance(field, dict):
+        # plain dict means nested structure for the same object
+        return compile_fields(field)
+
+    ftype = type(field)
+    get = _getter(key if field.attribute is None else field.attribute)
+    default = field.default
+
+    if ftype in _CONVERTERS or ftype is fields.DateTime:
+        if ftype is fields.DateTime:
+            # the same datetime values (e.g. of nested players)
+            # are formatted many times
+            convert = lru_cache(maxsize=1024)(field.format)
+        else:
+            convert = _CONVERTERS[ftype]
+
+        def output(obj):
+            value = get(obj)
+            if value is None:
+                return default
+            return convert(value) if convert else value
+        return output
+
+    if ftype is fields.Nested:
+        nested = _nested(field)
+        return lambda obj: nested(get(obj))
+
+    if ftype is fields.List and type(_make(field.container)) is fields.Nested:
+        nested = _nested(_make(field.container))
+
+        def output(obj):
+            value = get(obj)
+            if value is None:
+                return default
+            if not _is_list(value):
+                return field.output(key, obj)
+            return [nested(item) for item in value]
+        return output
+
+    # custom or complex field, let it handle itself
+    return lambda obj: field.output(key, obj)
+
+
+def compile_fields(fields_dict):
+    """
+    Returns function which serializes a single object
+    the same way as `marshal(obj, fields_dict)` does.
+    """
+    compiled = [
+        (key, _compile_field(key, field))
+        for key, field in fields_dict.items()
+    ]
+
+    def serialize(obj):
+        return OrderedDict([(key, output(obj)) for key, output in compiled])
+    return serialize
+
+
+class Serializer:
+    """
+    Compiled counterpart of a fields dict.
+    Calling it on an object is equivalent to `marshal(obj, fields)`,
+    calling `many` is equivalent to `fields.List(fields.Nested(fields))`.
+    """
+    def __init__(self, fields_dict):
+        self.fields = fields_dict
+        self.one = compile_fields(fields_dict)
+
+    def __call__(self, obj):
+        if isinstance(obj, (list, tuple)):
+            return [self.one(o) for o in obj]
+        return self.one(obj)
+
+    def many(self, objs):
+        return [self.one(o) for o in objs]
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+# Background worker: sends queued push notifications and mails.
+# Keeps APNS and Mailgun connections warm between batches,
+# so run it as a long-living daemon (see worker.sh).
+
+import eventlet
+eventlet.monkey_patch()
+
+import main, v1
+
+if __name__ == '__main__':
+    # for db access to work
+    main.live().app_context().push()
+
+    workers = [
+        eventlet.spawn(v1.helpers.push_worker),
+        eventlet.spawn(v1.apis.mail_worker),
+    ]
+    for worker in workers:
+        worker.wait()
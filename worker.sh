@@ -0,0 +1,5 @@
+#!/bin/bash
+
+cd "$(dirname "${BASH_SOURCE[0]}" )"
+source ../env/bin/activate
+exec ./worker.py >> ../worker.log 2>&1